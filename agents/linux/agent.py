@@ -4,30 +4,73 @@ ServerManager Linux Agent
 Collects system metrics and sends them to the management server.
 """
 
+import time
+
+# Measured from here so --once runs can check their startup-to-exit budget
+PROCESS_START = time.monotonic()
+
 import os
+import re
 import sys
 import json
-import time
+import mmap
+import queue
+import random
+import shutil
 import signal
 import socket
+import heapq
+import hashlib
 import logging
 import argparse
 import platform
+import tempfile
+import importlib
+import importlib.util
+import threading
 import subprocess
-from pathlib import Path
 from datetime import datetime
 
 try:
     import psutil
-    import requests
 except ImportError:
     print("Missing dependencies. Install with: pip3 install psutil requests")
     sys.exit(1)
 
+if importlib.util.find_spec("requests") is None:
+    print("Missing dependencies. Install with: pip3 install psutil requests")
+    sys.exit(1)
+
+
+class LazyModule:
+    """Imports a module on first attribute access.
+
+    requests and its dependency tree take longer to import than a whole
+    --once run needs, and the hot paths below don't use it.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+requests = LazyModule("requests")
+
 # Configuration
 CONFIG_FILE = "/etc/servermanager/agent.conf"
 LOG_FILE = "/var/log/servermanager-agent.log"
 PID_FILE = "/var/run/servermanager-agent.pid"
+STATE_DIR = "/var/lib/servermanager"
+JOURNAL_CURSOR_FILE = os.path.join(STATE_DIR, "journal_cursors.json")
+ONCE_STATE_FILE = os.path.join(STATE_DIR, "once_state.json")
+HOST_FACTS_FILE = os.path.join(STATE_DIR, "host_facts.json")
+CGROUP_ROOT = "/sys/fs/cgroup"
+PROC_ROOT = "/proc"
 
 DEFAULT_CONFIG = {
     "server_url": "https://localhost:3000",
@@ -35,27 +78,78 @@ DEFAULT_CONFIG = {
     "metrics_interval": 5,
     "heartbeat_interval": 30,
     "package_sync_interval": 3600,
+    "facts_interval": 300,
+    "serializer": "auto",
+    "log_search_workers": 4,
+    "journalctl_path": "journalctl",
+    "journal_max_bytes": 1048576,
+    "cgroup_top_n": 10,
+    "backoff_base": 2,
+    "backoff_max": 300,
+    "apt_get_path": "apt-get",
+    "prestage_enabled": False,
+    "prestage_window": "01:00-05:00",
+    "prestage_interval": 21600,
+    "prestage_max_age": 86400,
+    "prestage_bandwidth_kbps": 0,
+    "prestage_profile": "background",
+    "alert_hysteresis_percent": 5,
+    "exporter_listen": "",
+    "transfer_chunk_size": 4194304,
+    "transfer_retries": 3,
+    "once_time_budget": 2.0,
+    "resource_profiles": {
+        "default": {},
+        "background": {"nice": 10, "ionice_class": "idle", "cpu_quota": "50%"},
+    },
     "verify_ssl": True,
 }
 
 # Global state
 running = True
+host_facts = {"version": 0, "digest": None, "document": None, "sent": False}
+sent_process_names = {}
+cgroup_previous = {}
+counter_previous = {}
+backoff = {"failures": 0, "until": 0.0}
+prestage_state = {"last_run": None, "ready": False, "pending_downloads": [], "running": False}
+apt_lock = threading.Lock()
+alert_rules = []
+alert_state = {}
+pending_alert_events = []
+transfer_threads = {}
+latest_sample = {"metrics": None, "timestamp": None}
+agent_stats = {
+    "start_time": time.time(),
+    "samples_collected": 0,
+    "samples_sent": 0,
+    "send_failures": 0,
+    "alert_events": 0,
+    "last_collection_seconds": 0.0,
+}
+server_overrides = {}
 logger = logging.getLogger("servermanager-agent")
 
 
-def setup_logging():
+def setup_logging(console=True):
+    """Log to LOG_FILE, and to the console unless ``console`` is False.
+
+    The file is only opened on the first record, so a quiet --once run never
+    touches it.
+    """
     log_dir = os.path.dirname(LOG_FILE)
     os.makedirs(log_dir, exist_ok=True)
 
-    handler = logging.FileHandler(LOG_FILE)
+    handler = logging.FileHandler(LOG_FILE, delay=True)
     handler.setFormatter(
         logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
     )
     logger.addHandler(handler)
 
-    console = logging.StreamHandler()
-    console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-    logger.addHandler(console)
+    if console:
+        stream = logging.StreamHandler()
+        stream.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+        logger.addHandler(stream)
 
     logger.setLevel(logging.INFO)
 
@@ -84,99 +178,634 @@ def get_cpu_usage():
     return psutil.cpu_percent(interval=1)
 
 
-def get_memory_info():
-    mem = psutil.virtual_memory()
-    return {
-        "ram_total": mem.total,
-        "ram_used": mem.used,
-        "ram_usage_percent": mem.percent,
+def get_cpu_usage_delta():
+    """Non-blocking CPU usage since the snapshot kept in ``counter_previous``."""
+    times = psutil.cpu_times()
+    # guest time is already included in user/nice on Linux
+    total = sum(times) - getattr(times, "guest", 0) - getattr(times, "guest_nice", 0)
+    idle = times.idle + getattr(times, "iowait", 0)
+    previous = counter_previous.get("cpu")
+    counter_previous["cpu"] = {"total": total, "idle": idle}
+    if not previous or total <= previous["total"]:
+        return None
+    busy = 1 - (idle - previous["idle"]) / (total - previous["total"])
+    return round(max(0.0, min(100.0, busy * 100)), 1)
+
+
+def get_disk_info(partitions=None):
+    """Changing per-partition values; static details live in the host facts.
+
+    Pass the previous list to have its entries refilled in place.
+    """
+    if partitions is None:
+        partitions = []
+    count = 0
+    for part in psutil.disk_partitions():
+        try:
+            usage = psutil.disk_usage(part.mountpoint)
+        except PermissionError:
+            continue
+        if count < len(partitions):
+            entry = partitions[count]
+        else:
+            entry = {}
+            partitions.append(entry)
+        entry["mountpoint"] = part.mountpoint
+        entry["used"] = usage.used
+        entry["free"] = usage.free
+        entry["percent"] = usage.percent
+        count += 1
+    del partitions[count:]
+    return partitions
+
+
+def read_network_counters(sample, now=None):
+    """Set the network byte counters and rates on ``sample``."""
+    counters = psutil.net_io_counters()
+    now = now or time.time()
+    sample.network_rx_bytes = counters.bytes_recv
+    sample.network_tx_bytes = counters.bytes_sent
+    sample.network_rx_rate = None
+    sample.network_tx_rate = None
+    previous = counter_previous.get("network")
+    if previous and now > previous["time"]:
+        elapsed = now - previous["time"]
+        sample.network_rx_rate = int(max(0, counters.bytes_recv - previous["rx"]) / elapsed)
+        sample.network_tx_rate = int(max(0, counters.bytes_sent - previous["tx"]) / elapsed)
+    counter_previous["network"] = {
+        "time": now,
+        "rx": counters.bytes_recv,
+        "tx": counters.bytes_sent,
     }
 
 
-def get_disk_info():
+def _process_cpu(info):
+    return info["cpu_percent"] or 0.0
+
+
+def get_top_processes(count=10, procs=None):
+    """Top processes by CPU.
+
+    The process name is only included the first time a pid is reported;
+    the server keeps the pid -> name mapping and fills it in afterwards.
+    Pass the previous list to have its entries refilled in place.
+    """
+    if procs is None:
+        procs = []
+
+    def infos():
+        for proc in psutil.process_iter(["pid", "name", "cpu_percent", "memory_percent"]):
+            yield proc.info
+
+    top = heapq.nlargest(count, infos(), key=_process_cpu)
+
+    for index, info in enumerate(top):
+        if index < len(procs):
+            entry = procs[index]
+        else:
+            entry = {}
+            procs.append(entry)
+        entry["pid"] = info["pid"]
+        entry["cpu"] = info["cpu_percent"]
+        entry["memory"] = info["memory_percent"]
+        if sent_process_names.get(info["pid"]) == info["name"]:
+            entry.pop("name", None)
+        else:
+            entry["name"] = info["name"]
+            sent_process_names[info["pid"]] = info["name"]
+    del procs[len(top):]
+
+    # Forget pids that dropped out of the top list so the cache stays small
+    current = {proc["pid"] for proc in procs}
+    for pid in list(sent_process_names):
+        if pid not in current:
+            del sent_process_names[pid]
+
+    return procs
+
+
+def get_network_interfaces():
+    interfaces = []
+    stats = psutil.net_if_stats()
+    for name, addrs in psutil.net_if_addrs().items():
+        entry = {"name": name, "addresses": [], "mac": None}
+        for addr in addrs:
+            if addr.family == socket.AF_INET or addr.family == socket.AF_INET6:
+                entry["addresses"].append(addr.address)
+            elif addr.family == getattr(psutil, "AF_LINK", None):
+                entry["mac"] = addr.address
+        if name in stats:
+            entry["speed"] = stats[name].speed
+            entry["mtu"] = stats[name].mtu
+        interfaces.append(entry)
+    return interfaces
+
+
+def collect_host_facts():
+    """Collect values that rarely change (hardware, mounts, interfaces, OS)."""
     partitions = []
     for part in psutil.disk_partitions():
         try:
             usage = psutil.disk_usage(part.mountpoint)
-            partitions.append(
-                {
-                    "device": part.device,
-                    "mountpoint": part.mountpoint,
-                    "fstype": part.fstype,
-                    "total": usage.total,
-                    "used": usage.used,
-                    "free": usage.free,
-                    "percent": usage.percent,
-                }
-            )
         except PermissionError:
             continue
-    return partitions
-
+        partitions.append(
+            {
+                "device": part.device,
+                "mountpoint": part.mountpoint,
+                "fstype": part.fstype,
+                "total": usage.total,
+            }
+        )
 
-def get_network_info():
-    counters = psutil.net_io_counters()
     return {
-        "network_rx_bytes": counters.bytes_recv,
-        "network_tx_bytes": counters.bytes_sent,
+        "hostname": socket.gethostname(),
+        "os": platform.system(),
+        "os_release": platform.release(),
+        "os_version": platform.version(),
+        "architecture": platform.machine(),
+        "cpu_count": psutil.cpu_count(),
+        "ram_total": psutil.virtual_memory().total,
+        "swap_total": psutil.swap_memory().total,
+        "boot_time": int(psutil.boot_time()),
+        "disk_partitions": partitions,
+        "network_interfaces": get_network_interfaces(),
     }
 
 
-def get_load_average():
-    load = os.getloadavg()
+def refresh_host_facts():
+    """Re-collect host facts and bump the version if anything changed.
+
+    Returns True when the facts document needs to be (re)sent.
+    """
+    facts = collect_host_facts()
+    digest = hashlib.sha1(json.dumps(facts, sort_keys=True).encode()).hexdigest()
+    host_facts["document"] = facts
+    if digest != host_facts["digest"]:
+        # Time-based so versions keep increasing across agent restarts
+        host_facts["version"] = max(int(time.time()), host_facts["version"] + 1)
+        host_facts["digest"] = digest
+        host_facts["sent"] = False
+        save_host_facts_state()
+    return not host_facts["sent"]
+
+
+def load_host_facts_state():
+    """Restore version and digest so unchanged facts keep their version across restarts."""
+    state = load_state_file(HOST_FACTS_FILE)
+    for key in ("version", "digest", "sent"):
+        if key in state:
+            host_facts[key] = state[key]
+
+
+def save_host_facts_state():
+    try:
+        save_state_file(
+            HOST_FACTS_FILE, {key: host_facts[key] for key in ("version", "digest", "sent")}
+        )
+    except Exception as e:
+        logger.error(f"Failed to save host facts state: {e}")
+
+
+DOCKER_SCOPE = re.compile(r"^docker-([0-9a-f]{12,64})\.scope$")
+
+
+def _read_cgroup_file(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _read_cgroup_int(path):
+    value = _read_cgroup_file(path)
+    if value is None or value.strip() == "max":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def read_cgroup_stats(path):
+    """Read raw counters for one cgroup v2 directory."""
+    usage_usec = 0
+    cpu_stat = _read_cgroup_file(os.path.join(path, "cpu.stat")) or ""
+    for line in cpu_stat.splitlines():
+        key, _, value = line.partition(" ")
+        if key == "usage_usec":
+            usage_usec = int(value)
+            break
+
+    read_bytes = write_bytes = 0
+    io_stat = _read_cgroup_file(os.path.join(path, "io.stat")) or ""
+    for line in io_stat.splitlines():
+        # "<major>:<minor> rbytes=N wbytes=N rios=N wios=N ..."
+        for field in line.split()[1:]:
+            key, _, value = field.partition("=")
+            if key == "rbytes":
+                read_bytes += int(value)
+            elif key == "wbytes":
+                write_bytes += int(value)
+
     return {
-        "load_avg_1": round(load[0], 2),
-        "load_avg_5": round(load[1], 2),
-        "load_avg_15": round(load[2], 2),
+        "usage_usec": usage_usec,
+        "memory_bytes": _read_cgroup_int(os.path.join(path, "memory.current")),
+        "pids": _read_cgroup_int(os.path.join(path, "pids.current")),
+        "io_read_bytes": read_bytes,
+        "io_write_bytes": write_bytes,
     }
 
 
-def get_top_processes(count=10):
-    procs = []
-    for proc in psutil.process_iter(["pid", "name", "cpu_percent", "memory_percent"]):
-        try:
-            info = proc.info
-            procs.append(
-                {
-                    "pid": info["pid"],
-                    "name": info["name"],
-                    "cpu": info["cpu_percent"],
-                    "memory": info["memory_percent"],
-                }
-            )
-        except (psutil.NoSuchProcess, psutil.AccessDenied):
-            continue
-
-    procs.sort(key=lambda x: x["cpu"], reverse=True)
-    return procs[:count]
+def discover_cgroups(root=CGROUP_ROOT):
+    """Return (kind, name, path) for Docker containers and systemd services."""
+    found = []
+    system_slice = os.path.join(root, "system.slice")
+    try:
+        for entry in os.scandir(system_slice):
+            if not entry.is_dir():
+                continue
+            match = DOCKER_SCOPE.match(entry.name)
+            if match:
+                found.append(("container", match.group(1)[:12], entry.path))
+            elif entry.name.endswith(".service"):
+                found.append(("service", entry.name, entry.path))
+    except OSError:
+        pass
+
+    # Docker with the cgroupfs driver puts containers under /docker/<id>
+    try:
+        for entry in os.scandir(os.path.join(root, "docker")):
+            if entry.is_dir() and len(entry.name) >= 12:
+                found.append(("container", entry.name[:12], entry.path))
+    except OSError:
+        pass
+
+    return found
+
+
+def get_cgroup_metrics(root=CGROUP_ROOT, top_n=10, now=None):
+    """Per-container and per-service usage read straight from cgroupfs.
+
+    CPU and I/O rates are computed against the previous call; the first call
+    for a cgroup only reports memory and pids.
+    """
+    # Wall clock so previous counters stay usable across --once runs
+    now = now or time.time()
+    groups = {"containers": [], "services": []}
+    seen = set()
+
+    for kind, name, path in discover_cgroups(root):
+        stats = read_cgroup_stats(path)
+        seen.add(path)
+        entry = {
+            "name": name,
+            "memory_bytes": stats["memory_bytes"],
+            "pids": stats["pids"],
+            "cpu_percent": None,
+            "io_read_rate": None,
+            "io_write_rate": None,
+        }
+        previous = cgroup_previous.get(path)
+        if previous:
+            elapsed = now - previous["time"]
+            if elapsed > 0:
+                entry["cpu_percent"] = round(
+                    max(0, stats["usage_usec"] - previous["usage_usec"]) / (elapsed * 1e4), 2
+                )
+                entry["io_read_rate"] = int(
+                    max(0, stats["io_read_bytes"] - previous["io_read_bytes"]) / elapsed
+                )
+                entry["io_write_rate"] = int(
+                    max(0, stats["io_write_bytes"] - previous["io_write_bytes"]) / elapsed
+                )
+        stats["time"] = now
+        cgroup_previous[path] = stats
+        groups["containers" if kind == "container" else "services"].append(entry)
+
+    # Drop state for cgroups that have gone away
+    for path in list(cgroup_previous):
+        if path not in seen:
+            del cgroup_previous[path]
+
+    for key in groups:
+        groups[key].sort(
+            key=lambda e: (e["cpu_percent"] or 0, e["memory_bytes"] or 0), reverse=True
+        )
+        groups[key] = groups[key][:top_n]
+    return groups
+
+
+TCP_STATES = {
+    b"01": "ESTABLISHED",
+    b"02": "SYN_SENT",
+    b"03": "SYN_RECV",
+    b"04": "FIN_WAIT1",
+    b"05": "FIN_WAIT2",
+    b"06": "TIME_WAIT",
+    b"07": "CLOSE",
+    b"08": "CLOSE_WAIT",
+    b"09": "LAST_ACK",
+    b"0A": "LISTEN",
+    b"0B": "CLOSING",
+    b"0C": "NEW_SYN_RECV",
+}
+TCP_LISTEN = b"0A"
 
 
-def get_uptime():
-    return int(time.time() - psutil.boot_time())
+def _scan_proc_net_tcp(path, states, listening, port_connections):
+    """One streaming pass over /proc/net/tcp or tcp6."""
+    try:
+        f = open(path, "rb", buffering=1 << 16)
+    except OSError:
+        return
+    with f:
+        next(f, None)  # header
+        for line in f:
+            # sl local_address rem_address st tx_queue:rx_queue ...
+            parts = line.split(None, 5)
+            state = parts[3]
+            states[state] = states.get(state, 0) + 1
+            port = int(parts[1][-4:], 16)
+            if state == TCP_LISTEN:
+                # For listening sockets rx_queue is the accept queue, tx_queue the backlog
+                tx_queue, _, rx_queue = parts[4].partition(b":")
+                entry = listening.setdefault(port, {"accept_queue": 0, "backlog": 0})
+                entry["accept_queue"] += int(rx_queue, 16)
+                entry["backlog"] = max(entry["backlog"], int(tx_queue, 16))
+            else:
+                port_connections[port] = port_connections.get(port, 0) + 1
+
+
+def _scan_proc_net_udp(path, totals):
+    try:
+        f = open(path, "rb", buffering=1 << 16)
+    except OSError:
+        return
+    with f:
+        next(f, None)
+        for line in f:
+            totals["sockets"] += 1
+            totals["drops"] += int(line.rsplit(None, 1)[-1])
+
+
+def read_tcp_ext_counters(proc_root=PROC_ROOT, names=("ListenOverflows", "ListenDrops")):
+    """Read selected TcpExt counters from /proc/net/netstat."""
+    try:
+        with open(os.path.join(proc_root, "net", "netstat"), "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return {}
+    for header, values in zip(lines[::2], lines[1::2]):
+        if header.startswith("TcpExt:"):
+            counters = dict(zip(header.split()[1:], values.split()[1:]))
+            return {name: int(counters[name]) for name in names if name in counters}
+    return {}
+
+
+def get_socket_summary(proc_root=PROC_ROOT, top_ports=20):
+    """Summarise TCP/UDP sockets from /proc/net without walking per-process fds."""
+    states = {}
+    listening = {}
+    port_connections = {}
+    for name in ("tcp", "tcp6"):
+        _scan_proc_net_tcp(
+            os.path.join(proc_root, "net", name), states, listening, port_connections
+        )
 
+    udp = {"sockets": 0, "drops": 0}
+    for name in ("udp", "udp6"):
+        _scan_proc_net_udp(os.path.join(proc_root, "net", name), udp)
 
-def collect_metrics():
-    cpu = get_cpu_usage()
-    mem = get_memory_info()
-    disks = get_disk_info()
-    net = get_network_info()
-    load = get_load_average()
-    procs = get_top_processes()
-    uptime = get_uptime()
-    proc_count = len(list(psutil.process_iter()))
+    ports = [
+        {"port": port, "connections": port_connections.get(port, 0), **queues}
+        for port, queues in listening.items()
+    ]
+    ports.sort(key=lambda p: (p["connections"], p["accept_queue"]), reverse=True)
 
+    counters = read_tcp_ext_counters(proc_root)
     return {
-        "cpu_usage": cpu,
-        **mem,
-        "disk_partitions": disks,
-        **net,
-        **load,
-        "process_count": proc_count,
-        "top_processes": procs,
-        "uptime_seconds": uptime,
+        "tcp": {TCP_STATES.get(state, state.decode()): count for state, count in states.items()},
+        "udp": udp,
+        "listening": ports[:top_ports],
+        "listen_overflows": counters.get("ListenOverflows"),
+        "listen_drops": counters.get("ListenDrops"),
     }
 
 
+def write_socket_fixture(proc_root, sockets=100000):
+    """Write synthetic /proc/net files with ``sockets`` TCP entries for benchmarking."""
+    net = os.path.join(proc_root, "net")
+    os.makedirs(net, exist_ok=True)
+    header = (
+        "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt"
+        "   uid  timeout inode\n"
+    )
+    states = ["01"] * 6 + ["06"] * 3 + ["08"]
+    with open(os.path.join(net, "tcp"), "w") as f:
+        f.write(header)
+        for port in (22, 80, 443, 5432):
+            f.write(
+                f"   0: 00000000:{port:04X} 00000000:0000 0A 00000080:00000003 00:00000000"
+                " 00000000     0        0 1000 1 0000000000000000 100 0 0 10 0\n"
+            )
+        for i in range(sockets):
+            port = (80, 443, 5432)[i % 3]
+            f.write(
+                f"{i:6d}: 0100007F:{port:04X} 0200007F:{(i % 60000) + 1024:04X} "
+                f"{states[i % len(states)]} 00000000:00000000 00:00000000 00000000"
+                "  1000        0 12345 1 0000000000000000 20 4 30 10 -1\n"
+            )
+    for name in ("tcp6", "udp", "udp6"):
+        with open(os.path.join(net, name), "w") as f:
+            f.write(header)
+    with open(os.path.join(net, "netstat"), "w") as f:
+        f.write("TcpExt: ListenOverflows ListenDrops\nTcpExt: 12 15\n")
+
+
+def run_socket_benchmark(sockets=100000, iterations=5):
+    """Time get_socket_summary() against a synthetic fixture."""
+    with tempfile.TemporaryDirectory() as proc_root:
+        write_socket_fixture(proc_root, sockets)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            summary = get_socket_summary(proc_root)
+        elapsed = (time.perf_counter() - start) / iterations
+    print(f"{sockets} sockets: {elapsed * 1000:.1f} ms per summary")
+    print(json.dumps(summary["tcp"], sort_keys=True))
+
+
+SAMPLE_FIELDS = (
+    "facts_version",
+    "cpu_usage",
+    "ram_used",
+    "ram_usage_percent",
+    "disk_partitions",
+    "network_rx_bytes",
+    "network_tx_bytes",
+    "network_rx_rate",
+    "network_tx_rate",
+    "load_avg_1",
+    "load_avg_5",
+    "load_avg_15",
+    "process_count",
+    "top_processes",
+    "cgroups",
+    "sockets",
+    "edge_alerts",
+)
+
+
+class MetricsSample:
+    """Reusable metrics record; fields are overwritten in place every cycle."""
+
+    __slots__ = SAMPLE_FIELDS + ("_payload",)
+
+    def __init__(self):
+        for field in SAMPLE_FIELDS:
+            setattr(self, field, None)
+        self._payload = dict.fromkeys(SAMPLE_FIELDS)
+
+    def as_dict(self):
+        """Return the payload dict, refilled in place rather than rebuilt."""
+        payload = self._payload
+        for field in SAMPLE_FIELDS:
+            payload[field] = getattr(self, field)
+        return payload
+
+
+class Serializer:
+    """Encodes payloads to bytes with the fastest available library."""
+
+    __slots__ = ("name", "content_type", "_encode")
+
+    def __init__(self, name, content_type, encode):
+        self.name = name
+        self.content_type = content_type
+        self._encode = encode
+
+    def encode(self, obj):
+        if isinstance(obj, MetricsSample):
+            obj = obj.as_dict()
+        return self._encode(obj)
+
+
+def _json_encode(obj):
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def available_serializers():
+    serializers = {"json": Serializer("json", "application/json", _json_encode)}
+    # Optional faster serializers
+    try:
+        import orjson
+    except ImportError:
+        orjson = None
+    try:
+        import msgpack
+    except ImportError:
+        msgpack = None
+
+    if orjson is not None:
+        serializers["orjson"] = Serializer("orjson", "application/json", orjson.dumps)
+    if msgpack is not None:
+        serializers["msgpack"] = Serializer(
+            "msgpack", "application/msgpack", lambda obj: msgpack.packb(obj, use_bin_type=True)
+        )
+    return serializers
+
+
+def get_serializer(name="auto"):
+    """Pick a serializer by name; "auto" prefers orjson and falls back to json.
+
+    msgpack is only used when asked for explicitly since the server has to
+    have its optional decoder installed.
+    """
+    serializers = available_serializers()
+    if name == "auto":
+        return serializers.get("orjson") or serializers["json"]
+    if name not in serializers:
+        logger.warning(f"Serializer '{name}' not available, falling back to json")
+        return serializers["json"]
+    return serializers[name]
+
+
+def collect_metrics(sample=None, cgroup_top_n=10, blocking_cpu=True):
+    """Collect a metrics sample, reusing ``sample`` when one is passed in.
+
+    With ``blocking_cpu=False`` CPU usage comes from the previous cpu_times
+    snapshot instead of a one-second cpu_percent() measurement.
+    """
+    if sample is None:
+        sample = MetricsSample()
+
+    sample.facts_version = host_facts["version"]
+    sample.edge_alerts = bool(alert_rules)
+    if blocking_cpu:
+        sample.cpu_usage = get_cpu_usage()
+    else:
+        sample.cpu_usage = get_cpu_usage_delta()
+        if sample.cpu_usage is None:
+            # First run without a previous snapshot
+            sample.cpu_usage = psutil.cpu_percent(interval=0.1)
+    mem = psutil.virtual_memory()
+    sample.ram_used = mem.used
+    sample.ram_usage_percent = mem.percent
+    sample.disk_partitions = get_disk_info(sample.disk_partitions)
+    read_network_counters(sample)
+    load = os.getloadavg()
+    sample.load_avg_1 = round(load[0], 2)
+    sample.load_avg_5 = round(load[1], 2)
+    sample.load_avg_15 = round(load[2], 2)
+    sample.top_processes = get_top_processes(procs=sample.top_processes)
+    sample.process_count = len(psutil.pids())
+    sample.sockets = get_socket_summary()
+    if os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+        sample.cgroups = get_cgroup_metrics(top_n=cgroup_top_n)
+    return sample
+
+
+def run_serializer_benchmark(iterations=2000, collect_iterations=50):
+    """Compare the reused sample against building a fresh payload every cycle.
+
+    Encoding is timed for the refilled payload dict and for a dict built per
+    call; collection is timed and traced for a reused and a fresh sample.
+    """
+    import tracemalloc
+
+    sample = collect_metrics(blocking_cpu=False)
+    payload = sample.as_dict()
+    print(f"{'serializer':<10} {'us/reused':>10} {'us/fresh':>10} {'bytes/sample':>13}")
+    for name, serializer in available_serializers().items():
+        body = serializer.encode(payload)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            serializer.encode(sample)
+        reused = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(iterations):
+            serializer.encode({field: getattr(sample, field) for field in SAMPLE_FIELDS})
+        fresh = time.perf_counter() - start
+        print(
+            f"{name:<10} {reused / iterations * 1e6:>10.1f} "
+            f"{fresh / iterations * 1e6:>10.1f} {len(body):>13}"
+        )
+
+    for label, reuse in (("reused", True), ("fresh", False)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        for _ in range(collect_iterations):
+            collect_metrics(sample if reuse else None, blocking_cpu=False)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"collect ({label}): {elapsed / collect_iterations * 1000:.2f} ms/cycle, "
+            f"traced peak {peak / 1024:.1f} KiB"
+        )
+
+
 def get_installed_packages():
     """Get list of installed packages (Debian/Ubuntu)."""
     packages = []
@@ -215,9 +844,12 @@ def get_installed_packages():
                 version = line.split(" ")[1] if " " in line else ""
                 upgradable[name] = version
 
+        pending = set(prestage_state["pending_downloads"])
         for pkg in packages:
             if pkg["name"] in upgradable:
                 pkg["available_update"] = upgradable[pkg["name"]]
+                if prestage_state["last_run"]:
+                    pkg["prestaged"] = pkg["name"] not in pending
     except Exception as e:
         logger.error(f"Failed to check updates: {e}")
 
@@ -244,48 +876,704 @@ def read_log_file(log_path, lines=100, search=None):
         return {"content": f"Error reading {log_path}: {str(e)}", "total_lines": 0}
 
 
-def execute_update(package_names=None):
+SYSLOG_TIMESTAMP = re.compile(r"^([A-Z][a-z]{2}) +(\d{1,2}) (\d{2}:\d{2}:\d{2})")
+ISO_TIMESTAMP = re.compile(r"^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}")
+_SEARCH_DONE = object()
+
+
+def parse_log_timestamp(line, now=None):
+    """Return the epoch timestamp at the start of a log line, or None."""
+    match = ISO_TIMESTAMP.match(line)
+    if match:
+        try:
+            return datetime.fromisoformat(match.group(0)).timestamp()
+        except ValueError:
+            return None
+
+    match = SYSLOG_TIMESTAMP.match(line)
+    if match:
+        now = now or time.time()
+        year = datetime.fromtimestamp(now).year
+        try:
+            parsed = datetime.strptime(
+                f"{year} {match.group(1)} {match.group(2)} {match.group(3)}",
+                "%Y %b %d %H:%M:%S",
+            )
+        except ValueError:
+            return None
+        # Classic syslog has no year; lines "in the future" belong to last year
+        if parsed.timestamp() > now + 86400:
+            parsed = parsed.replace(year=year - 1)
+        return parsed.timestamp()
+
+    return None
+
+
+def find_rotated_logs(log_path, since=None):
+    """Return the live log and its rotations (name.1, name.2.gz, ...), newest first.
+
+    Files last modified before ``since`` cannot contain matching lines and are skipped.
+    """
+    directory, name = os.path.split(log_path)
+    rotation = re.compile(re.escape(name) + r"\.(\d+)(\.gz)?$")
+    rotated = []
+    try:
+        for entry in os.scandir(directory or "."):
+            match = rotation.match(entry.name)
+            if match:
+                rotated.append((int(match.group(1)), entry.path))
+    except OSError as e:
+        logger.warning(f"Cannot list {directory}: {e}")
+
+    files = [log_path] if os.path.exists(log_path) else []
+    files += [path for _, path in sorted(rotated)]
+    if since:
+        files = [path for path in files if os.path.getmtime(path) >= since]
+    return files
+
+
+def _search_log_file(path, regex, since, until, stop, results):
+    """Stream one (optionally gzipped) file and queue matching lines."""
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    if path.endswith(".gz"):
+        import gzip
+
+        opener = gzip.open
+    else:
+        opener = open
+    try:
+        with opener(path, "rt", errors="replace") as f:
+            timestamp = None
+            for lineno, line in enumerate(f, 1):
+                if stop.is_set():
+                    break
+                if since or until:
+                    # Continuation lines inherit the timestamp of the line before
+                    timestamp = parse_log_timestamp(line) or timestamp
+                    if timestamp is not None:
+                        if until and timestamp > until:
+                            break
+                        if since and timestamp < since:
+                            continue
+                if regex.search(line):
+                    if not put({"file": path, "line": lineno, "text": line.rstrip("\n")}):
+                        break
+    except Exception as e:
+        logger.warning(f"Log search failed for {path}: {e}")
+    finally:
+        put(_SEARCH_DONE)
+
+
+def iter_log_search(regex, paths, since=None, until=None, limit=1000, chunk_size=100, workers=4):
+    """Search several log files in parallel and yield matches in chunks.
+
+    Stops all workers once ``limit`` matches have been produced. Matches are
+    handed over through a bounded queue, so nothing is buffered beyond a few chunks.
+    """
+    if isinstance(regex, str):
+        regex = re.compile(regex)
+    if not paths:
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    stop = threading.Event()
+    results = queue.Queue(maxsize=chunk_size * 4)
+    pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths))))
+    for path in paths:
+        pool.submit(_search_log_file, path, regex, since, until, stop, results)
+
+    remaining = len(paths)
+    found = 0
+    chunk = []
+    try:
+        while remaining:
+            item = results.get()
+            if item is _SEARCH_DONE:
+                remaining -= 1
+                continue
+            chunk.append(item)
+            found += 1
+            if found >= limit:
+                break
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        stop.set()
+        pool.shutdown(wait=True)
+
+
+def send_log_search_chunk(config, search_id, matches, done=False):
+    """Stream a chunk of log search matches to the management server."""
+    try:
+        url = f"{config['server_url']}/api/agent/logs/search-results"
+        headers = {"X-Agent-API-Key": config["api_key"], "Content-Type": "application/json"}
+        requests.post(
+            url,
+            json={"search_id": search_id, "matches": matches, "done": done},
+            headers=headers,
+            verify=config["verify_ssl"],
+            timeout=10,
+        )
+    except Exception as e:
+        logger.error(f"Failed to send log search results: {e}")
+
+
+def run_log_search(config, search_id, params):
+    """Run a log search command and stream its matches back."""
+    try:
+        flags = re.IGNORECASE if params.get("ignore_case", True) else 0
+        regex = re.compile(params["pattern"], flags)
+    except (KeyError, re.error) as e:
+        return {"status": "failed", "output": f"Invalid search pattern: {e}"}
+
+    since = params.get("since")
+    until = params.get("until")
+    paths = []
+    for log_path in params.get("paths") or ["/var/log/syslog"]:
+        paths += find_rotated_logs(log_path, since=since)
+
+    total = 0
+    for chunk in iter_log_search(
+        regex,
+        paths,
+        since=since,
+        until=until,
+        limit=params.get("limit", 1000),
+        chunk_size=params.get("chunk_size", 100),
+        workers=config["log_search_workers"],
+    ):
+        total += len(chunk)
+        send_log_search_chunk(config, search_id, chunk)
+    send_log_search_chunk(config, search_id, [], done=True)
+
+    return {"status": "completed", "output": f"{total} matches in {len(paths)} files"}
+
+
+def load_state_file(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Failed to load state from {path}: {e}")
+        return {}
+
+
+def save_state_file(path, state):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def journal_cursor_key(unit=None, priority=None):
+    return f"unit={unit or '*'};priority={priority if priority is not None else '*'}"
+
+
+def _journal_field(entry, name):
+    value = entry.get(name)
+    # journald exports non-UTF-8 fields as byte arrays
+    if isinstance(value, list):
+        return bytes(value).decode("utf-8", errors="replace")
+    return value or ""
+
+
+def read_journal(journalctl="journalctl", unit=None, priority=None, cursor=None,
+                 limit=500, max_bytes=1048576):
+    """Read journal entries after ``cursor``, streaming ``journalctl -o json``.
+
+    Without a cursor only the last ``limit`` entries are returned. Reading stops
+    at ``limit`` entries or ``max_bytes`` of output, and the returned cursor points
+    at the last entry read, so the next call continues from there. ``truncated``
+    is only set when journalctl had more output after that point.
+    Returns (entries, cursor, truncated).
+    """
+    cmd = [journalctl, "-o", "json", "--no-pager"]
+    if unit:
+        cmd += ["-u", unit]
+    if priority is not None:
+        cmd += ["-p", str(priority)]
+    if cursor:
+        cmd.append(f"--after-cursor={cursor}")
+    else:
+        cmd += ["-n", str(limit)]
+
+    entries = []
+    used = 0
+    truncated = False
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        for raw in proc.stdout:
+            if len(entries) >= limit or used >= max_bytes:
+                # There is output past the limit, so more entries are pending
+                truncated = True
+                break
+            try:
+                entry = json.loads(raw)
+            except ValueError:
+                continue
+            used += len(raw)
+            entries.append(
+                {
+                    "cursor": entry.get("__CURSOR"),
+                    "timestamp": int(entry.get("__REALTIME_TIMESTAMP", 0)) / 1e6,
+                    "unit": _journal_field(entry, "_SYSTEMD_UNIT"),
+                    "identifier": _journal_field(entry, "SYSLOG_IDENTIFIER"),
+                    "priority": int(entry.get("PRIORITY", 6)),
+                    "message": _journal_field(entry, "MESSAGE"),
+                }
+            )
+            cursor = entry.get("__CURSOR") or cursor
+    finally:
+        if proc.poll() is None:
+            proc.terminate()
+        proc.wait()
+
+    return entries, cursor, truncated
+
+
+def format_journal_entries(entries):
+    lines = []
+    for entry in entries:
+        stamp = datetime.fromtimestamp(entry["timestamp"]).strftime("%b %d %H:%M:%S")
+        lines.append(f"{stamp} {entry['identifier'] or entry['unit']}: {entry['message']}")
+    return "\n".join(lines)
+
+
+def run_journal_replay(journalctl, page_size=10):
+    """Check cursor paging against a journalctl, e.g. testdata/journalctl.
+
+    Reads the whole journal once, then pages through it after its first cursor
+    and compares the pages with it. Returns True when they match.
+    """
+    everything, _, _ = read_journal(journalctl, limit=1000000)
+    tail, _, truncated = read_journal(journalctl, limit=page_size)
+    print(f"tail: {len(tail)} entries, more pending: {truncated}")
+    ok = tail == everything[-page_size:] and not truncated
+
+    paged = []
+    cursor = everything[0]["cursor"] if everything else None
+    while cursor:
+        page, next_cursor, truncated = read_journal(journalctl, cursor=cursor, limit=page_size)
+        print(f"after {cursor[-20:]}: {len(page)} entries, more pending: {truncated}")
+        paged += page
+        if not truncated:
+            break
+        cursor = next_cursor
+    ok = ok and paged == everything[1:]
+    print(format_journal_entries(everything[-3:]))
+    print("OK" if ok else "MISMATCH")
+    return ok
+
+
+def run_journal_read(config, params):
+    """Return new journal entries for a unit/priority filter and persist its cursor."""
+    unit = params.get("unit")
+    priority = params.get("priority")
+    key = journal_cursor_key(unit, priority)
+    cursors = load_state_file(JOURNAL_CURSOR_FILE)
+
+    try:
+        entries, cursor, truncated = read_journal(
+            journalctl=config["journalctl_path"],
+            unit=unit,
+            priority=priority,
+            cursor=None if params.get("reset") else cursors.get(key),
+            limit=params.get("limit", 500),
+            max_bytes=config["journal_max_bytes"],
+        )
+    except OSError as e:
+        return {"status": "failed", "output": f"journalctl not available: {e}"}
+
+    if cursor:
+        cursors[key] = cursor
+        try:
+            save_state_file(JOURNAL_CURSOR_FILE, cursors)
+        except Exception as e:
+            logger.error(f"Failed to save journal cursor: {e}")
+
+    send_log_content(
+        config,
+        f"journal:{unit or 'all'}",
+        format_journal_entries(entries),
+        len(entries),
+    )
+    more = " (more pending)" if truncated else ""
+    return {"status": "completed", "output": f"{len(entries)} new journal entries{more}"}
+
+
+def send_log_content(config, log_path, content, total_lines):
+    """Send log content to the management server."""
+    try:
+        url = f"{config['server_url']}/api/agent/logs/content"
+        headers = {"X-Agent-API-Key": config["api_key"], "Content-Type": "application/json"}
+        requests.post(
+            url,
+            json={"log_path": log_path, "content": content, "total_lines": total_lines},
+            headers=headers,
+            verify=config["verify_ssl"],
+            timeout=10,
+        )
+    except Exception as e:
+        logger.error(f"Failed to send log content: {e}")
+
+
+IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+
+def resolve_resource_profile(config, profile):
+    """Accept a profile dict or the name of one from ``resource_profiles``."""
+    if isinstance(profile, dict):
+        return profile
+    profiles = config.get("resource_profiles") or {}
+    if profile and profile not in profiles:
+        logger.warning(f"Unknown resource profile '{profile}', using default")
+    return profiles.get(profile or "default") or {}
+
+
+def build_governed_command(cmd, profile):
+    """Wrap ``cmd`` with nice, ionice and a transient systemd scope as requested."""
+    profile = profile or {}
+    wrapped = list(cmd)
+
+    ionice_class = profile.get("ionice_class")
+    if ionice_class is not None and shutil.which("ionice"):
+        ionice_class = IONICE_CLASSES.get(ionice_class, ionice_class)
+        ionice = ["ionice", "-c", str(ionice_class)]
+        if profile.get("ionice_level") is not None and int(ionice_class) in (1, 2):
+            ionice += ["-n", str(profile["ionice_level"])]
+        wrapped = ionice + wrapped
+
+    if profile.get("nice") is not None:
+        wrapped = ["nice", "-n", str(profile["nice"])] + wrapped
+
+    properties = []
+    if profile.get("memory_max"):
+        properties.append(f"MemoryMax={profile['memory_max']}")
+    if profile.get("cpu_quota"):
+        quota = str(profile["cpu_quota"])
+        properties.append(f"CPUQuota={quota if quota.endswith('%') else quota + '%'}")
+    if profile.get("io_weight"):
+        properties.append(f"IOWeight={profile['io_weight']}")
+
+    if properties:
+        # Same check as sd_booted(): systemd-run needs a running systemd
+        if shutil.which("systemd-run") and os.path.isdir("/run/systemd/system"):
+            scope = ["systemd-run", "--scope", "--quiet", "--collect"]
+            for prop in properties:
+                scope += ["-p", prop]
+            wrapped = scope + ["--"] + wrapped
+        else:
+            logger.warning("systemd not available, cgroup limits not applied")
+
+    return wrapped
+
+
+def _process_cgroup(pid):
+    """cgroup v2 path of ``pid`` relative to CGROUP_ROOT, or None."""
+    data = _read_cgroup_file(os.path.join(PROC_ROOT, str(pid), "cgroup")) or ""
+    for line in data.splitlines():
+        if line.startswith("0::"):
+            return line[3:]
+    return None
+
+
+class UsagePeakTracker:
+    """Peak CPU and memory of a running command.
+
+    Reads cpu.stat and memory.peak of the command's transient scope when it runs
+    in one, and otherwise sums CPU time and RSS over the process tree. Memory is
+    sampled on every call; CPU over ``window``-second intervals, where 100 means
+    one full core. wait4's ru_maxrss is no use here: it includes the forked copy
+    of the agent from before exec.
+    """
+
+    def __init__(self, pid, window=1.0):
+        self.pid = pid
+        self.window = window
+        self.peak = 0.0
+        self.peak_memory = 0
+        self.agent_cgroup = _process_cgroup(os.getpid())
+        self.source = None
+        self.last_time = None
+        self.last_cpu = None
+
+    def _read(self):
+        """Return (source, cpu_seconds, memory_bytes) for the command."""
+        cgroup = _process_cgroup(self.pid)
+        if cgroup and cgroup != self.agent_cgroup:
+            path = os.path.join(CGROUP_ROOT, cgroup.lstrip("/"))
+            # memory.peak needs Linux 5.19; memory.current is the sampled fallback
+            memory = _read_cgroup_int(os.path.join(path, "memory.peak"))
+            if memory is None:
+                memory = _read_cgroup_int(os.path.join(path, "memory.current"))
+            return cgroup, read_cgroup_stats(path)["usage_usec"] / 1e6, memory or 0
+
+        try:
+            root = psutil.Process(self.pid)
+            procs = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return None, None, None
+        cpu = 0.0
+        memory = 0
+        for proc in procs:
+            try:
+                with proc.oneshot():
+                    times = proc.cpu_times()
+                    rss = proc.memory_info().rss
+            except psutil.Error:
+                continue
+            # children_* holds the time of descendants that were already reaped
+            cpu += times.user + times.system + times.children_user + times.children_system
+            memory += rss
+        return "tree", cpu, memory
+
+    def sample(self, now=None):
+        now = now or time.monotonic()
+        source, cpu, memory = self._read()
+        if cpu is None:
+            return
+        self.peak_memory = max(self.peak_memory, memory)
+        if source == self.source and now - self.last_time < self.window:
+            return
+        if source == self.source:
+            used = max(0.0, cpu - self.last_cpu)
+            self.peak = max(self.peak, used / (now - self.last_time) * 100)
+        # Moving into the scope switches counters; start a new interval
+        self.source = source
+        self.last_time = now
+        self.last_cpu = cpu
+
+
+def run_governed(cmd, profile=None, timeout=600):
+    """Run a command under a resource profile and measure what it used.
+
+    Returns (returncode, output, usage). Raises subprocess.TimeoutExpired after
+    killing the command if it runs longer than ``timeout``.
+    """
+    started = time.monotonic()
+    with tempfile.TemporaryFile() as out:
+        proc = subprocess.Popen(
+            build_governed_command(cmd, profile), stdout=out, stderr=subprocess.STDOUT
+        )
+        deadline = started + timeout
+        timed_out = False
+        tracker = UsagePeakTracker(proc.pid)
+        while True:
+            tracker.sample()
+            # wait4 instead of Popen.wait so we get the child's rusage
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() > deadline:
+                proc.kill()
+                pid, status, rusage = os.wait4(proc.pid, 0)
+                timed_out = True
+                break
+            time.sleep(0.2)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        if timed_out:
+            raise subprocess.TimeoutExpired(cmd, timeout)
+
+        out.seek(0)
+        output = out.read().decode("utf-8", errors="replace")
+
+    wall = time.monotonic() - started
+    cpu_seconds = rusage.ru_utime + rusage.ru_stime
+    cpu_percent_avg = round(cpu_seconds / wall * 100, 1) if wall > 0 else 0
+    usage = {
+        "wall_seconds": round(wall, 2),
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_percent_avg": cpu_percent_avg,
+        # Commands shorter than one window only have their average
+        "cpu_percent_peak": round(max(tracker.peak, cpu_percent_avg), 1),
+        # Tree RSS, or the scope's memory.peak (page cache included); None when
+        # the command exited before it could be sampled
+        "max_rss_bytes": tracker.peak_memory or None,
+        "io_read_bytes": rusage.ru_inblock * 512,
+        "io_write_bytes": rusage.ru_oublock * 512,
+    }
+    return proc.returncode, output, usage
+
+
+def merge_resource_usage(first, second):
+    wall = first["wall_seconds"] + second["wall_seconds"]
+    cpu_seconds = first["cpu_seconds"] + second["cpu_seconds"]
+    return {
+        "wall_seconds": round(wall, 2),
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_percent_avg": round(cpu_seconds / wall * 100, 1) if wall > 0 else 0,
+        "cpu_percent_peak": max(first["cpu_percent_peak"], second["cpu_percent_peak"]),
+        "max_rss_bytes": max(first["max_rss_bytes"] or 0, second["max_rss_bytes"] or 0) or None,
+        "io_read_bytes": first["io_read_bytes"] + second["io_read_bytes"],
+        "io_write_bytes": first["io_write_bytes"] + second["io_write_bytes"],
+    }
+
+
+def in_time_window(window, now=None):
+    """Check whether the local time is inside "HH:MM-HH:MM" (may wrap midnight)."""
+    start, _, end = window.partition("-")
+    current = (now or datetime.now()).strftime("%H:%M")
+    start, end = start.strip(), end.strip()
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+
+def apt_pending_downloads(apt_get="apt-get"):
+    """Names of upgradable packages whose .deb is not in the apt cache yet."""
+    result = subprocess.run(
+        [apt_get, "upgrade", "--download-only", "--print-uris", "-y", "-qq"],
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    pending = []
+    for line in result.stdout.splitlines():
+        # 'http://.../libssl3_3.0.2_amd64.deb' libssl3_3.0.2_amd64.deb 1234 SHA256:...
+        parts = line.split()
+        if len(parts) >= 2 and parts[1].endswith(".deb"):
+            pending.append(parts[1].split("_", 1)[0])
+    return pending
+
+
+def run_prestage(config):
+    """Download pending upgrades into the apt cache without installing them."""
+    if not apt_lock.acquire(blocking=False):
+        logger.info("Package pre-staging skipped, apt is busy")
+        return
+
+    prestage_state["running"] = True
+    try:
+        apt_get = config["apt_get_path"]
+        profile = resolve_resource_profile(config, config["prestage_profile"])
+        logger.info("Pre-staging package downloads...")
+
+        run_governed([apt_get, "update"], profile, timeout=300)
+
+        cmd = [apt_get, "upgrade", "--download-only", "-y", "-q"]
+        if config["prestage_bandwidth_kbps"]:
+            limit = int(config["prestage_bandwidth_kbps"])
+            cmd += [
+                "-o",
+                f"Acquire::http::Dl-Limit={limit}",
+                "-o",
+                f"Acquire::https::Dl-Limit={limit}",
+            ]
+        returncode, output, usage = run_governed(cmd, profile, timeout=3600)
+        if returncode != 0:
+            logger.warning(f"Package pre-staging failed: {output[-500:]}")
+
+        pending = apt_pending_downloads(apt_get)
+        prestage_state["last_run"] = time.time()
+        prestage_state["pending_downloads"] = pending
+        prestage_state["ready"] = returncode == 0 and not pending
+        logger.info(
+            f"Package pre-staging finished ({len(pending)} downloads pending, "
+            f"{usage['wall_seconds']}s)"
+        )
+    except Exception as e:
+        logger.error(f"Package pre-staging error: {e}")
+    finally:
+        prestage_state["running"] = False
+        apt_lock.release()
+
+
+def maybe_start_prestage(config):
+    """Start pre-staging in the background when inside the off-peak window."""
+    if not config["prestage_enabled"] or prestage_state["running"]:
+        return
+    last_run = prestage_state["last_run"]
+    if last_run and time.time() - last_run < config["prestage_interval"]:
+        return
+    if not in_time_window(config["prestage_window"]):
+        return
+    threading.Thread(target=run_prestage, args=(config,), daemon=True).start()
+
+
+def prestage_is_fresh(config):
+    last_run = prestage_state["last_run"]
+    return (
+        prestage_state["ready"]
+        and last_run is not None
+        and time.time() - last_run < config["prestage_max_age"]
+    )
+
+
+def execute_update(package_names=None, profile=None, config=None):
     """Execute system updates."""
+    config = config or DEFAULT_CONFIG
+    apt_get = config["apt_get_path"]
+
+    # Never wait for a running pre-stage: this runs on the main loop, which
+    # would stop sending heartbeats, metrics and alerts for up to an hour
+    if not apt_lock.acquire(blocking=False):
+        logger.info("Update deferred, package pre-stage in progress")
+        return {
+            "status": "failed",
+            "log_output": "Busy: package pre-stage in progress, retry the update later",
+            "busy": True,
+        }
+
     try:
         logger.info("Starting system update...")
 
-        # Update package lists
-        result = subprocess.run(
-            ["apt-get", "update"],
-            capture_output=True,
-            text=True,
-            timeout=300,
-        )
+        # With a fresh pre-stage the cache already matches the package lists,
+        # so refreshing them would only invalidate the downloaded archives
+        update_output = ""
+        usage = None
+        full_upgrade = not package_names or package_names == ["*"]
+        if not (full_upgrade and prestage_is_fresh(config)):
+            _, update_output, usage = run_governed([apt_get, "update"], profile, timeout=300)
 
-        if package_names and package_names != ["*"]:
-            cmd = ["apt-get", "install", "-y"] + package_names
+        if not full_upgrade:
+            cmd = [apt_get, "install", "-y"] + package_names
         else:
-            cmd = ["apt-get", "upgrade", "-y"]
+            cmd = [apt_get, "upgrade", "-y"]
 
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=1800)
+        returncode, output, upgrade_usage = run_governed(cmd, profile, timeout=1800)
+        prestage_state["ready"] = False
+
+        if usage:
+            upgrade_usage = merge_resource_usage(usage, upgrade_usage)
 
         return {
-            "status": "completed" if result.returncode == 0 else "failed",
-            "log_output": result.stdout + result.stderr,
+            "status": "completed" if returncode == 0 else "failed",
+            "log_output": update_output + output,
+            "resource_usage": upgrade_usage,
         }
     except subprocess.TimeoutExpired:
         return {"status": "failed", "log_output": "Update timed out"}
     except Exception as e:
         return {"status": "failed", "log_output": str(e)}
+    finally:
+        apt_lock.release()
 
 
-def execute_script(script_content):
+def execute_script(script_content, profile=None):
     """Execute a custom script."""
     try:
-        result = subprocess.run(
-            ["bash", "-c", script_content],
-            capture_output=True,
-            text=True,
-            timeout=600,
-        )
+        returncode, output, usage = run_governed(["bash", "-c", script_content], profile)
         return {
-            "status": "completed" if result.returncode == 0 else "failed",
-            "output": result.stdout + result.stderr,
+            "status": "completed" if returncode == 0 else "failed",
+            "output": output,
+            "resource_usage": usage,
         }
     except subprocess.TimeoutExpired:
         return {"status": "failed", "output": "Script timed out"}
@@ -293,51 +1581,485 @@ def execute_script(script_content):
         return {"status": "failed", "output": str(e)}
 
 
-def send_metrics(config, metrics):
+class HttpResponse:
+    """The parts of a requests.Response the agent's hot paths use."""
+
+    __slots__ = ("status_code", "headers", "content")
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content or b"null")
+
+
+def post_to_server(config, path, body, content_type="application/json", timeout=10):
+    """POST to the management server with urllib.
+
+    Used for metrics, host facts, heartbeats and alert events so that these
+    paths (and --once runs) never pay for importing requests.
+    """
+    import ssl
+    import urllib.error
+    import urllib.request
+
+    if isinstance(body, (dict, list)):
+        body = _json_encode(body)
+
+    verify = config["verify_ssl"]
+    context = None
+    if config["server_url"].startswith("https"):
+        if verify is False:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        elif isinstance(verify, str):
+            context = ssl.create_default_context(cafile=verify)
+        else:
+            context = ssl.create_default_context()
+
+    request = urllib.request.Request(
+        f"{config['server_url']}{path}",
+        data=body,
+        method="POST",
+        headers={"X-Agent-API-Key": config["api_key"], "Content-Type": content_type},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout, context=context) as resp:
+            return HttpResponse(resp.status, resp.headers, resp.read())
+    except urllib.error.HTTPError as e:
+        return HttpResponse(e.code, e.headers, e.read())
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (seconds or HTTP date) into seconds."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def register_server_failure(config, retry_after=None):
+    """Back off after a failed request using exponential backoff with full jitter."""
+    backoff["failures"] += 1
+    agent_stats["send_failures"] += 1
+    if retry_after is not None:
+        # Add a little jitter so agents told the same Retry-After don't return together
+        delay = retry_after + random.uniform(0, min(retry_after, config["backoff_base"]) + 1)
+    else:
+        ceiling = config["backoff_base"] * 2 ** min(backoff["failures"], 16)
+        delay = random.uniform(0, min(config["backoff_max"], ceiling))
+    backoff["until"] = time.time() + delay
+    logger.warning(f"Server unavailable, backing off for {delay:.1f}s")
+
+
+def register_server_response(config, resp):
+    """Track backpressure signals; returns False if the request should count as failed."""
+    if resp.status_code == 429 or resp.status_code >= 500:
+        register_server_failure(config, parse_retry_after(resp.headers.get("Retry-After")))
+        return False
+    backoff["failures"] = 0
+    backoff["until"] = 0.0
+    return True
+
+
+def server_available():
+    return time.time() >= backoff["until"]
+
+
+def effective_interval(config, key):
+    """Configured interval, unless the server has asked agents to slow down."""
+    return max(config[key], server_overrides.get(key, 0))
+
+
+ALERT_CONDITIONS = {
+    "gt": lambda value, threshold: value > threshold,
+    "gte": lambda value, threshold: value >= threshold,
+    "lt": lambda value, threshold: value < threshold,
+    "lte": lambda value, threshold: value <= threshold,
+    "eq": lambda value, threshold: value == threshold,
+}
+
+
+def collect_alert_values(metrics):
+    """Cheap point-in-time values for the metrics named in ``metrics``."""
+    values = {}
+    if "cpu_usage" in metrics:
+        # Non-blocking: usage since the previous call, i.e. the last loop tick
+        values["cpu_usage"] = psutil.cpu_percent(interval=None)
+    if "ram_usage_percent" in metrics:
+        values["ram_usage_percent"] = psutil.virtual_memory().percent
+    if "swap_usage_percent" in metrics:
+        values["swap_usage_percent"] = psutil.swap_memory().percent
+    if "disk_usage" in metrics:
+        percents = [p["percent"] for p in get_disk_info()]
+        values["disk_usage"] = max(percents) if percents else None
+    if "temperature" in metrics and hasattr(psutil, "sensors_temperatures"):
+        readings = [
+            t.current for sensors in psutil.sensors_temperatures().values() for t in sensors
+        ]
+        values["temperature"] = max(readings) if readings else None
+    return values
+
+
+def evaluate_alert_rules(rules, values, config, now=None):
+    """Evaluate rules against one sample; returns alert events that changed state.
+
+    A rule fires once its condition has held for ``duration_seconds`` and only
+    resolves after the value moves back past the threshold by the hysteresis margin.
+    """
+    now = now or time.time()
+    events = []
+    for rule in rules:
+        value = values.get(rule["metric"])
+        check = ALERT_CONDITIONS.get(rule["condition"])
+        if value is None or check is None:
+            continue
+
+        threshold = float(rule["threshold"])
+        state = alert_state.setdefault(rule["id"], {"since": None, "firing": False})
+
+        if not state["firing"]:
+            if not check(value, threshold):
+                state["since"] = None
+                continue
+            state["since"] = state["since"] or now
+            if now - state["since"] < (rule.get("duration_seconds") or 0):
+                continue
+            state["firing"] = True
+            status = "firing"
+        else:
+            margin = rule.get("hysteresis")
+            if margin is None:
+                margin = abs(threshold) * config["alert_hysteresis_percent"] / 100
+            if rule["condition"] in ("gt", "gte"):
+                cleared = value < threshold - margin
+            elif rule["condition"] in ("lt", "lte"):
+                cleared = value > threshold + margin
+            else:
+                cleared = not check(value, threshold)
+            if not cleared:
+                continue
+            state["firing"] = False
+            state["since"] = None
+            status = "resolved"
+
+        events.append(
+            {
+                "rule_id": rule["id"],
+                "metric": rule["metric"],
+                "value": value,
+                "threshold": threshold,
+                "status": status,
+                "timestamp": now,
+            }
+        )
+    return events
+
+
+def apply_alert_rules(data):
+    """Replace the edge alert rule set with the one from a heartbeat reply."""
+    if "alert_rules" not in data:
+        return
+    rules = data["alert_rules"] or []
+    if [r["id"] for r in rules] != [r["id"] for r in alert_rules]:
+        logger.info(f"Received {len(rules)} alert rules")
+    alert_rules[:] = rules
+    known = {rule["id"] for rule in rules}
+    for rule_id in list(alert_state):
+        if rule_id not in known:
+            del alert_state[rule_id]
+
+    # Alerts the server still has open (raised before a restart, or server-side
+    # before edge evaluation) count as firing so the next clear sample resolves them
+    queued = {event["rule_id"] for event in pending_alert_events}
+    for rule_id in data.get("active_alert_rule_ids") or []:
+        if rule_id in known and rule_id not in queued:
+            state = alert_state.setdefault(rule_id, {"since": None, "firing": False})
+            state["firing"] = True
+
+
+def send_alert_events(config):
+    """Push queued alert events to the management server."""
+    if not pending_alert_events:
+        return
+    events = list(pending_alert_events)
+    try:
+        resp = post_to_server(config, "/api/agent/alerts/events", {"events": events})
+        if register_server_response(config, resp) and resp.status_code == 200:
+            del pending_alert_events[: len(events)]
+            agent_stats["alert_events"] += len(events)
+        else:
+            logger.warning(f"Alert events send failed: {resp.status_code}")
+    except Exception as e:
+        register_server_failure(config)
+        logger.error(f"Failed to send alert events: {e}")
+
+
+def _transfer_request(config, method, **kwargs):
+    """Request against the transfer API, retrying a chunk a few times with jitter."""
+    url = f"{config['server_url']}/api/agent/files/{kwargs.pop('endpoint')}"
+    headers = {"X-Agent-API-Key": config["api_key"], **kwargs.pop("headers", {})}
+    for attempt in range(config["transfer_retries"]):
+        try:
+            resp = requests.request(
+                method, url, headers=headers, verify=config["verify_ssl"], timeout=60, **kwargs
+            )
+            if resp.status_code == 429 or resp.status_code >= 500:
+                raise requests.HTTPError(f"HTTP {resp.status_code}", response=resp)
+            return resp
+        except requests.RequestException as e:
+            if attempt == config["transfer_retries"] - 1:
+                raise
+            delay = random.uniform(0, 2 ** attempt)
+            if e.response is not None:
+                retry_after = parse_retry_after(e.response.headers.get("Retry-After"))
+                if retry_after is not None:
+                    delay = min(retry_after, config["backoff_max"])
+            logger.warning(f"Transfer request failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def upload_file(config, transfer_id, path):
+    """Send a local file to the server in checksummed chunks, resuming where it left off.
+
+    The file is mmap'ed so chunks are sliced and hashed without re-reading it.
+    """
+    size = os.path.getsize(path)
+    chunk_size = config["transfer_chunk_size"]
+    resp = _transfer_request(
+        config, "GET", endpoint="status", params={"transfer_id": transfer_id}
+    )
+    resp.raise_for_status()
+    offset = resp.json()["next_offset"]
+    if resp.json().get("complete"):
+        return {"status": "completed", "output": f"{path} already transferred ({size} bytes)"}
+
+    rejected = 0
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        try:
+            while True:
+                if offset > size:
+                    raise ValueError(f"Server expects offset {offset} past end of file ({size})")
+                chunk = mapped[offset:offset + chunk_size]
+                resp = _transfer_request(
+                    config,
+                    "POST",
+                    endpoint="chunk",
+                    data=chunk,
+                    headers={
+                        "Content-Type": "application/octet-stream",
+                        "X-Transfer-Id": transfer_id,
+                        "X-Chunk-Offset": str(offset),
+                        "X-Chunk-Sha256": hashlib.sha256(chunk).hexdigest(),
+                        "X-Total-Size": str(size),
+                    },
+                )
+                if resp.status_code in (409, 422):
+                    # Server expects a different offset, or the chunk was corrupted in transit
+                    rejected += 1
+                    if rejected > config["transfer_retries"]:
+                        raise ValueError(
+                            f"Chunk at offset {offset} rejected {rejected} times "
+                            f"(HTTP {resp.status_code})"
+                        )
+                    offset = resp.json()["next_offset"]
+                    continue
+                resp.raise_for_status()
+                rejected = 0
+                offset = resp.json()["next_offset"]
+                if resp.json().get("complete") or offset >= size:
+                    break
+        finally:
+            if size:
+                mapped.close()
+
+    return {"status": "completed", "output": f"Uploaded {path} ({size} bytes)"}
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def download_file(config, transfer_id, path, size=None, sha256=None):
+    """Fetch a staged file from the server, resuming from this transfer's .part file.
+
+    The assembled file is checked against ``size`` and ``sha256`` from the
+    command before it replaces ``path``; a mismatch discards the partial file.
+    """
+    # Keyed by transfer so a leftover from another transfer is never resumed
+    part_path = f"{path}.{transfer_id}.part"
+    chunk_size = config["transfer_chunk_size"]
+    total = size
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        offset = os.fstat(fd).st_size
+        if total is not None and offset > total:
+            os.ftruncate(fd, 0)
+            offset = 0
+        while total is None or offset < total:
+            resp = _transfer_request(
+                config,
+                "GET",
+                endpoint="chunk",
+                params={"transfer_id": transfer_id, "offset": offset, "length": chunk_size},
+            )
+            resp.raise_for_status()
+            served = int(resp.headers["X-Total-Size"])
+            if total is not None and served != total:
+                raise ValueError(f"Staged file is {served} bytes, expected {total}")
+            total = served
+            if offset > total:
+                os.ftruncate(fd, 0)
+                offset = 0
+                continue
+            chunk = resp.content
+            if hashlib.sha256(chunk).hexdigest() != resp.headers.get("X-Chunk-Sha256"):
+                raise ValueError(f"Checksum mismatch for chunk at offset {offset}")
+            if not chunk and offset < total:
+                raise ValueError(f"Empty chunk at offset {offset} of {total}")
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    actual_size = os.path.getsize(part_path)
+    if actual_size != total or (sha256 and _file_sha256(part_path) != sha256.lower()):
+        os.unlink(part_path)
+        raise ValueError(f"Downloaded file does not match the staged file ({actual_size} bytes)")
+
+    os.replace(part_path, path)
+    return {"status": "completed", "output": f"Downloaded {path} ({total} bytes)"}
+
+
+def run_file_transfer(config, params):
+    """Run a file_transfer command; a failed transfer resumes when re-issued."""
+    direction = params.get("direction")
+    transfer_id = params.get("transfer_id")
+    path = params.get("path")
+    if not transfer_id or not path or direction not in ("upload", "download"):
+        return {"status": "failed", "output": "transfer_id, path and direction are required"}
+
+    try:
+        if direction == "upload":
+            return upload_file(config, transfer_id, path)
+        return download_file(
+            config, transfer_id, path, size=params.get("size"), sha256=params.get("sha256")
+        )
+    except Exception as e:
+        return {"status": "failed", "output": f"Transfer of {path} interrupted: {e}"}
+
+
+def send_metrics(config, metrics, serializer=None):
     """Send metrics to the management server."""
     try:
-        url = f"{config['server_url']}/api/agent/metrics"
-        headers = {"X-Agent-API-Key": config["api_key"], "Content-Type": "application/json"}
-        resp = requests.post(
-            url, json=metrics, headers=headers, verify=config["verify_ssl"], timeout=10
+        serializer = serializer or get_serializer(config["serializer"])
+        resp = post_to_server(
+            config, "/api/agent/metrics", serializer.encode(metrics), serializer.content_type
         )
-        if resp.status_code != 200:
+        if not register_server_response(config, resp) or resp.status_code != 200:
             logger.warning(f"Metrics send failed: {resp.status_code}")
+            sent_process_names.clear()
+            return
+
+        agent_stats["samples_sent"] += 1
+        data = resp.json()
+        if data.get("facts_required"):
+            host_facts["sent"] = False
+        if data.get("process_names_required"):
+            sent_process_names.clear()
     except Exception as e:
+        sent_process_names.clear()
+        register_server_failure(config)
         logger.error(f"Failed to send metrics: {e}")
 
 
+def send_host_facts(config):
+    """Send the host facts document to the management server."""
+    try:
+        resp = post_to_server(
+            config,
+            "/api/agent/facts",
+            {"version": host_facts["version"], "facts": host_facts["document"]},
+        )
+        if register_server_response(config, resp) and resp.status_code == 200:
+            host_facts["sent"] = True
+            save_host_facts_state()
+            logger.info(f"Host facts sent (version {host_facts['version']})")
+        else:
+            logger.warning(f"Host facts send failed: {resp.status_code}")
+    except Exception as e:
+        register_server_failure(config)
+        logger.error(f"Failed to send host facts: {e}")
+
+
 def send_heartbeat(config):
     """Send heartbeat and receive pending commands."""
     try:
-        url = f"{config['server_url']}/api/agent/heartbeat"
-        headers = {"X-Agent-API-Key": config["api_key"], "Content-Type": "application/json"}
-        resp = requests.post(url, json={}, headers=headers, verify=config["verify_ssl"], timeout=10)
+        resp = post_to_server(config, "/api/agent/heartbeat", {})
 
-        if resp.status_code == 200:
+        if not register_server_response(config, resp):
+            logger.warning(f"Heartbeat rejected: {resp.status_code}")
+        elif resp.status_code == 200:
             data = resp.json()
+            apply_server_intervals(data)
+            apply_alert_rules(data)
             if data.get("pending_commands"):
                 process_commands(config, data["pending_commands"])
     except Exception as e:
+        register_server_failure(config)
         logger.error(f"Heartbeat failed: {e}")
 
 
+def apply_server_intervals(data):
+    """Honour a sample interval suggested by the server in its heartbeat reply."""
+    suggested = data.get("sample_interval")
+    if suggested:
+        if server_overrides.get("metrics_interval") != suggested:
+            logger.info(f"Server requested sample interval of {suggested}s")
+        server_overrides["metrics_interval"] = suggested
+    elif server_overrides.pop("metrics_interval", None) is not None:
+        logger.info("Server sample interval override removed")
+
+
 def sync_packages(config):
     """Sync installed packages with the management server."""
     try:
         packages = get_installed_packages()
         url = f"{config['server_url']}/api/agent/packages/sync"
         headers = {"X-Agent-API-Key": config["api_key"], "Content-Type": "application/json"}
+        prestage = {
+            "ready": prestage_is_fresh(config),
+            "last_run": prestage_state["last_run"],
+            "pending_downloads": len(prestage_state["pending_downloads"]),
+        }
         resp = requests.post(
             url,
-            json={"packages": packages},
+            json={"packages": packages, "prestage": prestage},
             headers=headers,
             verify=config["verify_ssl"],
             timeout=60,
         )
-        if resp.status_code == 200:
+        if register_server_response(config, resp) and resp.status_code == 200:
             logger.info(f"Synced {len(packages)} packages")
     except Exception as e:
+        register_server_failure(config)
         logger.error(f"Package sync failed: {e}")
 
 
@@ -345,8 +2067,9 @@ def process_commands(config, commands):
     """Process pending commands from the server."""
     for cmd in commands:
         logger.info(f"Processing command: {cmd['type']}")
+        profile = resolve_resource_profile(config, cmd.get("resource_profile"))
         if cmd["type"] == "update":
-            result = execute_update()
+            result = execute_update(profile=profile, config=config)
             report_task_result(config, cmd["id"], result)
         elif cmd["type"] == "reboot":
             report_task_result(
@@ -354,8 +2077,48 @@ def process_commands(config, commands):
             )
             subprocess.run(["shutdown", "-r", "+1", "Scheduled reboot by ServerManager"])
         elif cmd["type"] == "script" and cmd.get("script_content"):
-            result = execute_script(cmd["script_content"])
+            result = execute_script(cmd["script_content"], profile=profile)
+            report_task_result(config, cmd["id"], result)
+        elif cmd["type"] == "log_search":
+            result = run_log_search(config, cmd["id"], cmd.get("params") or {})
             report_task_result(config, cmd["id"], result)
+        elif cmd["type"] == "journal_read":
+            result = run_journal_read(config, cmd.get("params") or {})
+            report_task_result(config, cmd["id"], result)
+        elif cmd["type"] == "file_transfer":
+            start_file_transfer(config, cmd)
+
+
+def start_file_transfer(config, cmd):
+    """Run a file_transfer command in the background so heartbeats and metrics go on."""
+    params = cmd.get("params") or {}
+    transfer_id = params.get("transfer_id")
+    thread = transfer_threads.get(transfer_id)
+    if thread and thread.is_alive():
+        report_task_result(
+            config,
+            cmd["id"],
+            {"status": "failed", "output": f"Transfer {transfer_id} is already running"},
+        )
+        return
+
+    def run():
+        try:
+            result = run_file_transfer(config, params)
+        except Exception as e:
+            result = {"status": "failed", "output": str(e)}
+        report_task_result(config, cmd["id"], result)
+
+    thread = threading.Thread(target=run, name=f"transfer-{transfer_id}", daemon=True)
+    transfer_threads[transfer_id] = thread
+    thread.start()
+
+
+def wait_for_transfers():
+    """Let background transfers finish, e.g. before a --once run exits."""
+    for transfer_id, thread in list(transfer_threads.items()):
+        thread.join()
+        transfer_threads.pop(transfer_id, None)
 
 
 def report_task_result(config, task_id, result):
@@ -374,6 +2137,277 @@ def report_task_result(config, task_id, result):
         logger.error(f"Failed to report task result: {e}")
 
 
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class OpenMetricsWriter:
+    """Accumulates metric families in OpenMetrics text format."""
+
+    def __init__(self, prefix="servermanager_"):
+        self.prefix = prefix
+        self.lines = []
+
+    def family(self, name, kind, help_text, samples):
+        """Add a family; ``samples`` is a list of (labels dict, value)."""
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            return
+        name = self.prefix + name
+        self.lines.append(f"# TYPE {name} {kind}")
+        self.lines.append(f"# HELP {name} {help_text}")
+        suffix = "_total" if kind == "counter" else ""
+        for labels, value in samples:
+            label_text = ""
+            if labels:
+                label_text = "{" + ",".join(
+                    f'{key}="{_escape_label(val)}"' for key, val in labels.items()
+                ) + "}"
+            self.lines.append(f"{name}{suffix}{label_text} {value}")
+
+    def gauge(self, name, help_text, value, labels=None):
+        self.family(name, "gauge", help_text, [(labels or {}, value)])
+
+    def render(self):
+        return "\n".join(self.lines + ["# EOF"]) + "\n"
+
+
+def render_openmetrics():
+    """Render the cached latest sample plus agent stats; never collects anew."""
+    writer = OpenMetricsWriter()
+    metrics = latest_sample["metrics"] or {}
+    facts = host_facts["document"] or {}
+
+    writer.gauge("cpu_usage_percent", "CPU usage in percent.", metrics.get("cpu_usage"))
+    writer.gauge("memory_total_bytes", "Total physical memory.", facts.get("ram_total"))
+    writer.gauge("memory_used_bytes", "Used physical memory.", metrics.get("ram_used"))
+    writer.gauge(
+        "memory_usage_percent",
+        "Physical memory usage in percent.",
+        metrics.get("ram_usage_percent"),
+    )
+    writer.gauge("boot_time_seconds", "Host boot time (unix time).", facts.get("boot_time"))
+    for period in (1, 5, 15):
+        writer.gauge(
+            f"load{period}", f"{period}-minute load average.", metrics.get(f"load_avg_{period}")
+        )
+    writer.gauge("processes", "Number of processes.", metrics.get("process_count"))
+    writer.family(
+        "network_receive_bytes",
+        "counter",
+        "Bytes received on all interfaces.",
+        [({}, metrics.get("network_rx_bytes"))],
+    )
+    writer.family(
+        "network_transmit_bytes",
+        "counter",
+        "Bytes sent on all interfaces.",
+        [({}, metrics.get("network_tx_bytes"))],
+    )
+
+    partitions = metrics.get("disk_partitions") or []
+    writer.family(
+        "filesystem_size_bytes",
+        "gauge",
+        "Filesystem size.",
+        [
+            (
+                {"mountpoint": p["mountpoint"], "device": p["device"], "fstype": p["fstype"]},
+                p["total"],
+            )
+            for p in facts.get("disk_partitions") or []
+        ],
+    )
+    writer.family(
+        "filesystem_used_bytes",
+        "gauge",
+        "Filesystem space used.",
+        [({"mountpoint": p["mountpoint"]}, p["used"]) for p in partitions],
+    )
+    writer.family(
+        "filesystem_free_bytes",
+        "gauge",
+        "Filesystem space free.",
+        [({"mountpoint": p["mountpoint"]}, p["free"]) for p in partitions],
+    )
+
+    cgroups = metrics.get("cgroups") or {}
+    entries = [
+        ({"kind": kind.rstrip("s"), "name": e["name"]}, e)
+        for kind in ("containers", "services")
+        for e in cgroups.get(kind, [])
+    ]
+    writer.family(
+        "cgroup_cpu_percent",
+        "gauge",
+        "CPU usage of a container or service in percent.",
+        [(labels, e["cpu_percent"]) for labels, e in entries],
+    )
+    writer.family(
+        "cgroup_memory_bytes",
+        "gauge",
+        "Memory charged to a container or service.",
+        [(labels, e["memory_bytes"]) for labels, e in entries],
+    )
+    writer.family(
+        "cgroup_pids",
+        "gauge",
+        "Tasks in a container or service.",
+        [(labels, e["pids"]) for labels, e in entries],
+    )
+
+    sockets = metrics.get("sockets") or {}
+    writer.family(
+        "tcp_sockets",
+        "gauge",
+        "TCP sockets by state.",
+        [({"state": state}, count) for state, count in (sockets.get("tcp") or {}).items()],
+    )
+    writer.family(
+        "tcp_listen_accept_queue",
+        "gauge",
+        "Connections waiting in a listening port's accept queue.",
+        [({"port": p["port"]}, p["accept_queue"]) for p in sockets.get("listening") or []],
+    )
+    writer.family(
+        "tcp_listen_overflows",
+        "counter",
+        "Times a listen queue overflowed.",
+        [({}, sockets.get("listen_overflows"))],
+    )
+    writer.gauge("udp_sockets", "UDP sockets.", (sockets.get("udp") or {}).get("sockets"))
+
+    writer.gauge(
+        "sample_timestamp_seconds",
+        "When the cached sample was collected.",
+        latest_sample["timestamp"],
+    )
+    writer.gauge("agent_start_time_seconds", "Agent start time.", agent_stats["start_time"])
+    writer.gauge(
+        "agent_collection_duration_seconds",
+        "Duration of the last metrics collection.",
+        round(agent_stats["last_collection_seconds"], 6),
+    )
+    for key, help_text in (
+        ("samples_collected", "Metrics samples collected."),
+        ("samples_sent", "Metrics samples accepted by the server."),
+        ("send_failures", "Failed requests to the server."),
+        ("alert_events", "Alert events pushed to the server."),
+    ):
+        writer.family(f"agent_{key}", "counter", help_text, [({}, agent_stats[key])])
+    writer.gauge(
+        "agent_resident_memory_bytes", "Agent resident memory.", psutil.Process().memory_info().rss
+    )
+    return writer.render()
+
+
+def start_exporter(listen):
+    """Serve /metrics on "host:port" or "unix:/path" in a background thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_openmetrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def address_string(self):
+            # Unix socket clients have no (host, port) address
+            return self.client_address[0] if self.client_address else "unix"
+
+        def log_message(self, format, *args):
+            logger.debug("exporter: " + format % args)
+
+    class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+        daemon_threads = True
+
+    if listen.startswith("unix:"):
+        path = listen[len("unix:"):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = ThreadingUnixHTTPServer(path, MetricsRequestHandler)
+        os.chmod(path, 0o660)
+    else:
+        host, _, port = listen.rpartition(":")
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), MetricsRequestHandler)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"OpenMetrics exporter listening on {listen}")
+    return server
+
+
+def run_once(config):
+    """Single collection for cron/systemd-timer runs.
+
+    Counter snapshots, host facts version, backoff and schedule times are kept
+    in a small state file so rates, CPU deltas and intervals work across runs.
+    """
+    state = load_state_file(ONCE_STATE_FILE)
+    load_host_facts_state()
+    counter_previous.update(state.get("counters") or {})
+    cgroup_previous.update(state.get("cgroups") or {})
+    backoff.update(state.get("backoff") or {})
+    last_runs = state.get("last_runs") or {}
+    now = time.time()
+
+    # Refresh before collecting so the sample carries the current facts version
+    if now - last_runs.get("facts", 0) >= config["facts_interval"] or not host_facts["sent"]:
+        try:
+            refresh_host_facts()
+        except Exception as e:
+            logger.error(f"Host facts collection error: {e}")
+        last_runs["facts"] = now
+
+    sample = collect_metrics(cgroup_top_n=config["cgroup_top_n"], blocking_cpu=False)
+
+    if server_available():
+        if not host_facts["sent"] and host_facts["document"]:
+            send_host_facts(config)
+
+        send_metrics(config, sample, get_serializer(config["serializer"]))
+
+    if server_available():
+        send_heartbeat(config)
+
+    if now - last_runs.get("package_sync", 0) >= config["package_sync_interval"]:
+        if server_available():
+            sync_packages(config)
+            last_runs["package_sync"] = now
+
+    wait_for_transfers()
+
+    elapsed = time.monotonic() - PROCESS_START
+    try:
+        save_state_file(
+            ONCE_STATE_FILE,
+            {
+                "counters": counter_previous,
+                "cgroups": cgroup_previous,
+                "backoff": backoff,
+                "last_runs": last_runs,
+                "last_run_seconds": round(elapsed, 3),
+            },
+        )
+    except Exception as e:
+        logger.error(f"Failed to save state: {e}")
+
+    if elapsed > config["once_time_budget"]:
+        logger.warning(
+            f"Run took {elapsed:.2f}s, over the {config['once_time_budget']}s budget"
+        )
+    return elapsed
+
+
 def signal_handler(signum, frame):
     global running
     logger.info("Received shutdown signal")
@@ -388,9 +2422,38 @@ def main():
     parser.add_argument("--api-key", help="Agent API key")
     parser.add_argument("--configure", action="store_true", help="Configure the agent")
     parser.add_argument("--once", action="store_true", help="Run once and exit")
+    parser.add_argument(
+        "--benchmark-serializers",
+        action="store_true",
+        help="Benchmark metrics payload encoding and exit",
+    )
+    parser.add_argument(
+        "--benchmark-sockets",
+        type=int,
+        metavar="N",
+        help="Benchmark the socket summary collector on N synthetic sockets and exit",
+    )
+    parser.add_argument(
+        "--replay-journal",
+        metavar="JOURNALCTL",
+        help="Check journal cursor paging against a journalctl (or testdata/journalctl) and exit",
+    )
     args = parser.parse_args()
 
-    setup_logging()
+    if args.replay_journal:
+        sys.exit(0 if run_journal_replay(args.replay_journal) else 1)
+
+    if args.benchmark_serializers:
+        run_serializer_benchmark()
+        return
+
+    if args.benchmark_sockets:
+        run_socket_benchmark(args.benchmark_sockets)
+        return
+
+    # Timer/cron runs log to the file only; a console copy would just be
+    # duplicated into the journal or cron mail
+    setup_logging(console=not args.once)
     config = load_config()
 
     if args.configure or args.server_url or args.api_key:
@@ -416,40 +2479,106 @@ def main():
         logger.error("No API key configured. Run with --configure first.")
         sys.exit(1)
 
+    if args.once:
+        run_once(config)
+        return
+
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
 
-    logger.info(f"ServerManager Agent starting (server: {config['server_url']})")
+    serializer = get_serializer(config["serializer"])
+    # Alternate between two records so the exporter keeps reading a complete
+    # sample while the next one is filled in place
+    samples = (MetricsSample(), MetricsSample())
 
-    last_metrics = 0
-    last_heartbeat = 0
-    last_package_sync = 0
+    if config["exporter_listen"]:
+        try:
+            start_exporter(config["exporter_listen"])
+        except Exception as e:
+            logger.error(f"Failed to start exporter: {e}")
+
+    logger.info(
+        f"ServerManager Agent starting (server: {config['server_url']}, "
+        f"serializer: {serializer.name})"
+    )
+
+    # Facts are collected before the first sample so every sample carries
+    # their version; with unchanged facts that is the version the server has
+    load_host_facts_state()
+    try:
+        refresh_host_facts()
+    except Exception as e:
+        logger.error(f"Host facts collection error: {e}")
+
+    # Spread the start phase across the interval so a fleet restarting
+    # together does not hit the server in lockstep, including the facts upload
+    start = time.time()
+    last_facts_check = start
+    facts_upload_at = start + random.uniform(0, config["heartbeat_interval"])
+    last_metrics = start - random.uniform(0, config["metrics_interval"])
+    last_heartbeat = start - random.uniform(0, config["heartbeat_interval"])
+    last_package_sync = start - config["package_sync_interval"] + random.uniform(
+        0, config["heartbeat_interval"]
+    )
 
     while running:
         now = time.time()
 
-        # Send metrics
-        if now - last_metrics >= config["metrics_interval"]:
+        # Evaluate edge alert rules on every loop tick, between metric samples too
+        if alert_rules:
+            try:
+                values = collect_alert_values({rule["metric"] for rule in alert_rules})
+                pending_alert_events.extend(evaluate_alert_rules(alert_rules, values, config, now))
+            except Exception as e:
+                logger.error(f"Alert evaluation error: {e}")
+
+        # Re-check host facts periodically; changes go out ahead of the next metrics
+        if now - last_facts_check >= config["facts_interval"]:
             try:
-                metrics = collect_metrics()
-                send_metrics(config, metrics)
+                refresh_host_facts()
+            except Exception as e:
+                logger.error(f"Host facts collection error: {e}")
+            last_facts_check = now
+
+        # Collect on schedule even while backing off, so the local exporter
+        # keeps serving current values when the server is unreachable
+        if now - last_metrics >= effective_interval(config, "metrics_interval"):
+            try:
+                sample = samples[agent_stats["samples_collected"] % 2]
+                started = time.monotonic()
+                collect_metrics(sample, cgroup_top_n=config["cgroup_top_n"])
+                agent_stats["last_collection_seconds"] = time.monotonic() - started
+                agent_stats["samples_collected"] += 1
+                latest_sample["metrics"] = sample.as_dict()
+                latest_sample["timestamp"] = time.time()
+                if server_available():
+                    facts_pending = not host_facts["sent"] and host_facts["document"]
+                    if facts_pending and now >= facts_upload_at:
+                        send_host_facts(config)
+                    send_metrics(config, sample, serializer)
                 last_metrics = now
             except Exception as e:
                 logger.error(f"Metrics collection error: {e}")
 
+        if not server_available():
+            time.sleep(1)
+            continue
+
+        send_alert_events(config)
+
         # Send heartbeat
-        if now - last_heartbeat >= config["heartbeat_interval"]:
+        if now - last_heartbeat >= config["heartbeat_interval"] and server_available():
             send_heartbeat(config)
             last_heartbeat = now
 
+        # Pre-stage package downloads during the off-peak window
+        maybe_start_prestage(config)
+
         # Sync packages
-        if now - last_package_sync >= config["package_sync_interval"]:
+        if now - last_package_sync >= config["package_sync_interval"] and server_available():
             sync_packages(config)
             last_package_sync = now
 
-        if args.once:
-            break
-
         time.sleep(1)
 
     logger.info("Agent stopped")
@@ -0,0 +1,16 @@
+exports.up = function (knex) {
+  return knex.schema.alterTable('servers', (table) => {
+    // Static host facts reported by the agent (hardware, mounts, interfaces, OS)
+    table.jsonb('host_facts').nullable();
+    table.bigInteger('host_facts_version').nullable();
+    table.timestamp('host_facts_updated_at').nullable();
+  });
+};
+
+exports.down = function (knex) {
+  return knex.schema.alterTable('servers', (table) => {
+    table.dropColumn('host_facts');
+    table.dropColumn('host_facts_version');
+    table.dropColumn('host_facts_updated_at');
+  });
+};
@@ -0,0 +1,12 @@
+exports.up = function (knex) {
+  return knex.schema.alterTable('server_metrics', (table) => {
+    // Top Docker containers and systemd services by resource usage (cgroup v2)
+    table.jsonb('cgroups').nullable();
+  });
+};
+
+exports.down = function (knex) {
+  return knex.schema.alterTable('server_metrics', (table) => {
+    table.dropColumn('cgroups');
+  });
+};
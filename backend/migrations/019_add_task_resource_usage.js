@@ -0,0 +1,12 @@
+exports.up = function (knex) {
+  return knex.schema.alterTable('task_logs', (table) => {
+    // Wall/CPU time, peak RSS and block I/O reported by the agent
+    table.jsonb('resource_usage').nullable();
+  });
+};
+
+exports.down = function (knex) {
+  return knex.schema.alterTable('task_logs', (table) => {
+    table.dropColumn('resource_usage');
+  });
+};
@@ -0,0 +1,20 @@
+exports.up = function (knex) {
+  return knex.schema
+    .alterTable('server_packages', (table) => {
+      // Update already downloaded into the agent's apt cache
+      table.boolean('prestaged').defaultTo(false);
+    })
+    .alterTable('servers', (table) => {
+      table.jsonb('package_prestage').nullable();
+    });
+};
+
+exports.down = function (knex) {
+  return knex.schema
+    .alterTable('server_packages', (table) => {
+      table.dropColumn('prestaged');
+    })
+    .alterTable('servers', (table) => {
+      table.dropColumn('package_prestage');
+    });
+};
@@ -0,0 +1,12 @@
+exports.up = function (knex) {
+  return knex.schema.alterTable('server_metrics', (table) => {
+    // TCP/UDP socket state summary (counts per state, listening ports, listen overflows)
+    table.jsonb('sockets').nullable();
+  });
+};
+
+exports.down = function (knex) {
+  return knex.schema.alterTable('server_metrics', (table) => {
+    table.dropColumn('sockets');
+  });
+};
@@ -0,0 +1,16 @@
+const { setTaskTypes } = require('../src/config/taskTypes');
+
+// One-shot agent commands carry their arguments in params
+exports.up = async function (knex) {
+  await knex.schema.alterTable('scheduled_tasks', (table) => {
+    table.jsonb('params').nullable();
+  });
+  await setTaskTypes(knex, 'log_search');
+};
+
+exports.down = async function (knex) {
+  await setTaskTypes(knex, 'script');
+  await knex.schema.alterTable('scheduled_tasks', (table) => {
+    table.dropColumn('params');
+  });
+};
@@ -0,0 +1,9 @@
+const { setTaskTypes } = require('../src/config/taskTypes');
+
+exports.up = function (knex) {
+  return setTaskTypes(knex, 'journal_read');
+};
+
+exports.down = function (knex) {
+  return setTaskTypes(knex, 'log_search');
+};
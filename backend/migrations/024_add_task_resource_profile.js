@@ -0,0 +1,12 @@
+exports.up = function (knex) {
+  return knex.schema.alterTable('scheduled_tasks', (table) => {
+    // Name of an agent-side resource profile (nice/ionice/cgroup limits)
+    table.string('resource_profile', 50).nullable();
+  });
+};
+
+exports.down = function (knex) {
+  return knex.schema.alterTable('scheduled_tasks', (table) => {
+    table.dropColumn('resource_profile');
+  });
+};
@@ -0,0 +1,13 @@
+exports.up = function (knex) {
+  return knex.schema.alterTable('alert_rules', (table) => {
+    // Margin (in metric units) the value must clear before a firing alert resolves;
+    // null uses the agent's alert_hysteresis_percent of the threshold
+    table.float('hysteresis').nullable();
+  });
+};
+
+exports.down = function (knex) {
+  return knex.schema.alterTable('alert_rules', (table) => {
+    table.dropColumn('hysteresis');
+  });
+};
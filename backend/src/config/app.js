@@ -15,6 +15,14 @@ module.exports = {
   },
   agent: {
     apiKey: process.env.AGENT_API_KEY || 'dev-agent-key',
+    // Optional fleet-wide sample interval (seconds) pushed to agents via heartbeat
+    sampleInterval: parseInt(process.env.AGENT_SAMPLE_INTERVAL, 10) || null,
+  },
+  transfers: {
+    // Kept outside uploads/, which is served statically without authentication
+    dir: process.env.TRANSFER_DIR || require('path').join(__dirname, '../../data/transfers'),
+    // Staged files, finished uploads and abandoned .part files are removed after this
+    retentionHours: parseInt(process.env.TRANSFER_RETENTION_HOURS, 10) || 24,
   },
   smtp: {
     host: process.env.SMTP_HOST,
@@ -0,0 +1,24 @@
+// Every scheduled_tasks.type in the order it was introduced. Append only:
+// migrations refer to positions in this list.
+const TASK_TYPES = ['update', 'reboot', 'script', 'log_search', 'journal_read', 'file_transfer'];
+
+// Task types the agent runs once; they are deactivated as they are handed out
+const ONE_SHOT_TASK_TYPES = ['log_search', 'journal_read', 'file_transfer'];
+
+// Allow the task types up to and including lastType, removing tasks of any later type
+const setTaskTypes = async (knex, lastType) => {
+  const types = TASK_TYPES.slice(0, TASK_TYPES.indexOf(lastType) + 1);
+  const list = types.map((type) => `'${type}'`).join(', ');
+
+  await knex('scheduled_tasks').whereNotIn('type', types).del();
+  await knex.raw('ALTER TABLE scheduled_tasks DROP CONSTRAINT IF EXISTS scheduled_tasks_type_check');
+  await knex.raw(
+    `ALTER TABLE scheduled_tasks ADD CONSTRAINT scheduled_tasks_type_check CHECK (type IN (${list}))`
+  );
+};
+
+module.exports = {
+  TASK_TYPES,
+  ONE_SHOT_TASK_TYPES,
+  setTaskTypes,
+};
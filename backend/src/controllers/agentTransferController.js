@@ -0,0 +1,269 @@
+const fs = require('fs');
+const path = require('path');
+const crypto = require('crypto');
+const { v4: uuidv4 } = require('uuid');
+const config = require('../config/app');
+const logger = require('../services/logger');
+const { queueAgentCommand } = require('../services/agentCommands');
+
+/**
+ * Chunked file transfers through the agent's authenticated HTTP channel.
+ *
+ * Files live in <transfers dir>/<server_id>/<transfer_id>, outside the public
+ * uploads/ tree, and are removed after the retention period. Agent -> server
+ * transfers are written to a .part file that only grows by verified chunks,
+ * so its size is always the offset to resume from.
+ */
+
+const TRANSFER_DIR = config.transfers.dir;
+const UUID_RE = /^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$/i;
+const MAX_CHUNK_SIZE = 8 * 1024 * 1024;
+
+function transferPath(serverId, transferId) {
+  if (!UUID_RE.test(transferId || '')) return null;
+  return path.join(TRANSFER_DIR, serverId, transferId);
+}
+
+function hashFile(filePath) {
+  return new Promise((resolve, reject) => {
+    const hash = crypto.createHash('sha256');
+    fs.createReadStream(filePath)
+      .on('error', reject)
+      .on('data', (data) => hash.update(data))
+      .on('end', () => resolve(hash.digest('hex')));
+  });
+}
+
+// Destination/source paths on the agent host must be absolute
+function isAgentPath(value) {
+  return typeof value === 'string' && path.posix.isAbsolute(value) && !value.includes('\0');
+}
+
+function fileSize(filePath) {
+  try {
+    return fs.statSync(filePath).size;
+  } catch (e) {
+    return 0;
+  }
+}
+
+// Agent: how much of an agent -> server transfer has already arrived
+exports.getStatus = async (req, res) => {
+  try {
+    const target = transferPath(req.server.id, req.query.transfer_id);
+    if (!target) {
+      return res.status(400).json({ error: 'Invalid transfer id' });
+    }
+
+    if (fs.existsSync(target)) {
+      return res.json({ next_offset: fileSize(target), complete: true });
+    }
+    res.json({ next_offset: fileSize(`${target}.part`), complete: false });
+  } catch (err) {
+    logger.error('Get transfer status error:', err);
+    res.status(500).json({ error: 'Internal server error' });
+  }
+};
+
+// Agent: append one checksummed chunk of an agent -> server transfer
+exports.receiveChunk = async (req, res) => {
+  try {
+    const server = req.server;
+    const target = transferPath(server.id, req.get('X-Transfer-Id'));
+    const offset = parseInt(req.get('X-Chunk-Offset'), 10);
+    const totalSize = parseInt(req.get('X-Total-Size'), 10);
+    const checksum = req.get('X-Chunk-Sha256');
+    const chunk = Buffer.isBuffer(req.body) ? req.body : Buffer.alloc(0);
+
+    if (!target || Number.isNaN(offset) || Number.isNaN(totalSize) || !checksum) {
+      return res.status(400).json({ error: 'Missing transfer headers' });
+    }
+
+    const digest = crypto.createHash('sha256').update(chunk).digest('hex');
+    if (digest !== checksum.toLowerCase()) {
+      return res.status(422).json({ error: 'Chunk checksum mismatch', next_offset: offset });
+    }
+
+    const partPath = `${target}.part`;
+    fs.mkdirSync(path.dirname(target), { recursive: true });
+    let current = fileSize(partPath);
+    if (current > totalSize) {
+      // Left over from an earlier, larger attempt under the same id
+      fs.unlinkSync(partPath);
+      current = 0;
+    }
+    if (offset !== current) {
+      return res.status(409).json({ error: 'Unexpected offset', next_offset: current });
+    }
+
+    fs.appendFileSync(partPath, chunk);
+    const nextOffset = current + chunk.length;
+
+    if (nextOffset >= totalSize) {
+      fs.renameSync(partPath, target);
+      const io = req.app.get('io');
+      if (io) {
+        io.to(`server:${server.id}`).emit('file_transfer_complete', {
+          server_id: server.id,
+          transfer_id: req.get('X-Transfer-Id'),
+          size: nextOffset,
+        });
+      }
+    }
+
+    res.json({ status: 'ok', next_offset: nextOffset, complete: nextOffset >= totalSize });
+  } catch (err) {
+    logger.error('Receive transfer chunk error:', err);
+    res.status(500).json({ error: 'Internal server error' });
+  }
+};
+
+// Agent: fetch one chunk of a server -> agent transfer
+exports.sendChunk = async (req, res) => {
+  try {
+    const source = transferPath(req.server.id, req.query.transfer_id);
+    if (!source || !fs.existsSync(source)) {
+      return res.status(404).json({ error: 'Transfer not found' });
+    }
+
+    const totalSize = fileSize(source);
+    const offset = Math.max(0, parseInt(req.query.offset, 10) || 0);
+    const length = Math.min(parseInt(req.query.length, 10) || MAX_CHUNK_SIZE, MAX_CHUNK_SIZE);
+    const chunk = Buffer.alloc(Math.max(0, Math.min(length, totalSize - offset)));
+
+    const fd = fs.openSync(source, 'r');
+    try {
+      fs.readSync(fd, chunk, 0, chunk.length, offset);
+    } finally {
+      fs.closeSync(fd);
+    }
+
+    res.set({
+      'Content-Type': 'application/octet-stream',
+      'X-Total-Size': String(totalSize),
+      'X-Chunk-Offset': String(offset),
+      'X-Chunk-Sha256': crypto.createHash('sha256').update(chunk).digest('hex'),
+    });
+    res.send(chunk);
+  } catch (err) {
+    logger.error('Send transfer chunk error:', err);
+    res.status(500).json({ error: 'Internal server error' });
+  }
+};
+
+// User: download a file the agent has finished uploading
+exports.download = async (req, res) => {
+  try {
+    const source = transferPath(req.params.serverId, req.params.transferId);
+    if (!source || !fs.existsSync(source)) {
+      return res.status(404).json({ error: 'Transfer not found or not complete' });
+    }
+
+    res.download(source, req.query.filename || req.params.transferId);
+  } catch (err) {
+    logger.error('Download transfer error:', err);
+    res.status(500).json({ error: 'Internal server error' });
+  }
+};
+
+// User: stage a file and queue a file_transfer command for the agent to fetch it
+exports.stage = async (req, res) => {
+  try {
+    if (!req.file) {
+      return res.status(400).json({ error: 'No file uploaded' });
+    }
+    if (!isAgentPath(req.body.path)) {
+      fs.unlinkSync(req.file.path);
+      return res.status(400).json({ error: 'An absolute destination path is required' });
+    }
+
+    const transferId = path.basename(req.file.filename);
+    // The agent checks the assembled file against this before moving it into place
+    const sha256 = await hashFile(req.file.path);
+
+    const task = await queueAgentCommand({
+      serverId: req.params.serverId,
+      type: 'file_transfer',
+      name: `File transfer to ${req.body.path}`.slice(0, 255),
+      params: {
+        transfer_id: transferId,
+        direction: 'download',
+        path: req.body.path,
+        size: req.file.size,
+        sha256,
+      },
+      userId: req.user.id,
+    });
+
+    res.status(202).json({
+      transfer_id: transferId,
+      task_id: task.id,
+      size: req.file.size,
+      sha256,
+    });
+  } catch (err) {
+    logger.error('Stage transfer error:', err);
+    res.status(500).json({ error: 'Internal server error' });
+  }
+};
+
+// User: queue a file_transfer command for the agent to upload one of its files
+exports.requestUpload = async (req, res) => {
+  try {
+    if (!isAgentPath(req.body.path)) {
+      return res.status(400).json({ error: 'An absolute source path is required' });
+    }
+
+    const transferId = uuidv4();
+    const task = await queueAgentCommand({
+      serverId: req.params.serverId,
+      type: 'file_transfer',
+      name: `File transfer from ${req.body.path}`.slice(0, 255),
+      params: {
+        transfer_id: transferId,
+        direction: 'upload',
+        path: req.body.path,
+      },
+      userId: req.user.id,
+    });
+
+    // file_transfer_complete is emitted once the last chunk arrives
+    res.status(202).json({ transfer_id: transferId, task_id: task.id });
+  } catch (err) {
+    logger.error('Request transfer upload error:', err);
+    res.status(500).json({ error: 'Internal server error' });
+  }
+};
+
+/**
+ * Remove staged files, finished uploads and stale .part files past retention
+ */
+exports.cleanup = async () => {
+  const cutoff = Date.now() - config.transfers.retentionHours * 3600 * 1000;
+  let removed = 0;
+
+  const serverDirs = await fs.promises.readdir(TRANSFER_DIR).catch(() => []);
+  for (const serverId of serverDirs) {
+    const dir = path.join(TRANSFER_DIR, serverId);
+    const entries = await fs.promises.readdir(dir).catch(() => []);
+    for (const name of entries) {
+      const filePath = path.join(dir, name);
+      const stat = await fs.promises.stat(filePath).catch(() => null);
+      // .part files grow with every chunk, so only idle ones are this old
+      if (stat && stat.isFile() && stat.mtimeMs < cutoff) {
+        await fs.promises.unlink(filePath);
+        removed++;
+      }
+    }
+    if (entries.length > 0 && (await fs.promises.readdir(dir)).length === 0) {
+      await fs.promises.rmdir(dir);
+    }
+  }
+
+  if (removed > 0) {
+    logger.info(`Transfer cleanup: removed ${removed} files`);
+  }
+};
+
+exports.MAX_CHUNK_SIZE = MAX_CHUNK_SIZE;
+exports.TRANSFER_DIR = TRANSFER_DIR;
@@ -33,6 +33,7 @@ exports.createRule = async (req, res) => {
       condition,
       threshold,
       duration_seconds,
+      hysteresis,
       severity,
       notify_email,
       notify_webhook,
@@ -51,6 +52,7 @@ exports.createRule = async (req, res) => {
       condition,
       threshold: parseFloat(threshold),
       duration_seconds: duration_seconds || 60,
+      hysteresis: hysteresis === undefined || hysteresis === null ? null : parseFloat(hysteresis),
       severity: severity || 'warning',
       is_active: true,
       notify_email: notify_email !== false,
@@ -2,6 +2,7 @@ const { Client: SSHClient } = require('ssh2');
 const db = require('../config/database');
 const { decryptCredentials } = require('../services/encryption');
 const logger = require('../services/logger');
+const { queueAgentCommand } = require('../services/agentCommands');
 
 // Log templates that can be added by users
 const LOG_TEMPLATES = {
@@ -396,6 +397,126 @@ exports.receiveLogContent = async (req, res) => {
   }
 };
 
+// Accepts epoch seconds or anything Date.parse understands
+const toEpochSeconds = (value) => {
+  if (value === undefined || value === null || value === '') return undefined;
+  const seconds = typeof value === 'number' ? value : Date.parse(value) / 1000;
+  return Number.isFinite(seconds) ? seconds : NaN;
+};
+
+exports.requestLogSearch = async (req, res) => {
+  try {
+    const { pattern, paths, since, until, ignore_case, limit } = req.body;
+    const serverId = req.params.serverId;
+
+    if (!pattern) {
+      return res.status(400).json({ error: 'pattern is required' });
+    }
+    if (paths !== undefined && (!Array.isArray(paths) || !paths.every((p) => typeof p === 'string'))) {
+      return res.status(400).json({ error: 'paths must be a list of log file paths' });
+    }
+
+    const sinceSeconds = toEpochSeconds(since);
+    const untilSeconds = toEpochSeconds(until);
+    if (Number.isNaN(sinceSeconds) || Number.isNaN(untilSeconds)) {
+      return res.status(400).json({ error: 'Invalid since/until timestamp' });
+    }
+
+    const server = await db('servers').where({ id: serverId }).first();
+    if (!server) {
+      return res.status(404).json({ error: 'Server not found' });
+    }
+
+    // Matches are streamed back over the socket as log_search_results with this search_id
+    const task = await queueAgentCommand({
+      serverId,
+      type: 'log_search',
+      name: `Log search: ${pattern}`.slice(0, 255),
+      params: {
+        pattern,
+        paths,
+        since: sinceSeconds,
+        until: untilSeconds,
+        ignore_case: ignore_case !== false,
+        limit: Math.min(Math.max(parseInt(limit) || 1000, 1), 10000),
+      },
+      userId: req.user.id,
+    });
+
+    res.status(202).json({ search_id: task.id, status: 'queued' });
+  } catch (err) {
+    logger.error('Request log search error:', err);
+    res.status(500).json({ error: 'Internal server error' });
+  }
+};
+
+const JOURNAL_PRIORITIES = ['emerg', 'alert', 'crit', 'err', 'warning', 'notice', 'info', 'debug'];
+
+exports.requestJournalRead = async (req, res) => {
+  try {
+    const { unit, priority, limit, reset } = req.body;
+    const serverId = req.params.serverId;
+
+    if (unit !== undefined && unit !== null && !/^[\w@.:-]+$/.test(unit)) {
+      return res.status(400).json({ error: 'Invalid unit name' });
+    }
+    if (
+      priority !== undefined &&
+      priority !== null &&
+      !JOURNAL_PRIORITIES.includes(priority) &&
+      !(Number.isInteger(priority) && priority >= 0 && priority <= 7)
+    ) {
+      return res.status(400).json({ error: 'priority must be 0-7 or a syslog level name' });
+    }
+
+    const server = await db('servers').where({ id: serverId }).first();
+    if (!server) {
+      return res.status(404).json({ error: 'Server not found' });
+    }
+
+    // New entries arrive over the socket as log_content for journal:<unit>
+    const task = await queueAgentCommand({
+      serverId,
+      type: 'journal_read',
+      name: `Journal read: ${unit || 'all'}`,
+      params: {
+        unit: unit || null,
+        priority: priority === undefined ? null : priority,
+        limit: Math.min(Math.max(parseInt(limit) || 500, 1), 5000),
+        reset: !!reset,
+      },
+      userId: req.user.id,
+    });
+
+    res.status(202).json({ task_id: task.id, log_path: `journal:${unit || 'all'}`, status: 'queued' });
+  } catch (err) {
+    logger.error('Request journal read error:', err);
+    res.status(500).json({ error: 'Internal server error' });
+  }
+};
+
+exports.receiveLogSearchResults = async (req, res) => {
+  try {
+    const server = req.server;
+    const { search_id, matches, done } = req.body;
+
+    const io = req.app.get('io');
+    if (io) {
+      io.to(`server:${server.id}`).emit('log_search_results', {
+        server_id: server.id,
+        search_id,
+        matches: matches || [],
+        done: !!done,
+      });
+    }
+
+    res.json({ status: 'ok' });
+  } catch (err) {
+    logger.error('Receive log search results error:', err);
+    res.status(500).json({ error: 'Internal server error' });
+  }
+};
+
 function executeSSHCommand(server, credentials, command) {
   return new Promise((resolve, reject) => {
     const sshConn = new SSHClient();
@@ -1,5 +1,10 @@
 const db = require('../config/database');
 const logger = require('../services/logger');
+const config = require('../config/app');
+const { getPendingCommands } = require('../services/agentCommands');
+
+// pid -> process name per server; agents only send a name the first time a pid is reported
+const processNameCache = new Map();
 
 exports.getCurrent = async (req, res) => {
   try {
@@ -58,9 +63,84 @@ exports.getHistory = async (req, res) => {
   }
 };
 
+exports.receiveHostFacts = async (req, res) => {
+  try {
+    const server = req.server;
+    const { version, facts } = req.body;
+
+    if (!version || !facts) {
+      return res.status(400).json({ error: 'version and facts are required' });
+    }
+
+    await db('servers')
+      .where({ id: server.id })
+      .update({
+        host_facts: JSON.stringify(facts),
+        host_facts_version: version,
+        host_facts_updated_at: new Date(),
+      });
+
+    res.json({ status: 'ok' });
+  } catch (err) {
+    logger.error('Receive host facts error:', err);
+    res.status(500).json({ error: 'Internal server error' });
+  }
+};
+
+/**
+ * Fill in values that agents using the host facts protocol no longer repeat
+ * in every sample (ram_total, partition details, uptime, process names).
+ */
+function hydrateSample(server, sample) {
+  const result = { factsRequired: false, processNamesRequired: false };
+
+  if (sample.facts_version !== undefined) {
+    const facts = server.host_facts;
+    if (!facts || Number(server.host_facts_version) !== Number(sample.facts_version)) {
+      result.factsRequired = true;
+    } else {
+      if (sample.ram_total === undefined) sample.ram_total = facts.ram_total;
+      if (sample.swap_total === undefined) sample.swap_total = facts.swap_total;
+      if (sample.uptime_seconds === undefined && facts.boot_time) {
+        sample.uptime_seconds = Math.max(0, Math.floor(Date.now() / 1000) - facts.boot_time);
+      }
+      if (Array.isArray(sample.disk_partitions) && Array.isArray(facts.disk_partitions)) {
+        const byMount = new Map(facts.disk_partitions.map((p) => [p.mountpoint, p]));
+        sample.disk_partitions = sample.disk_partitions.map((p) => ({
+          ...(byMount.get(p.mountpoint) || {}),
+          ...p,
+        }));
+      }
+    }
+  }
+
+  if (Array.isArray(sample.top_processes)) {
+    let names = processNameCache.get(server.id);
+    if (!names) {
+      names = new Map();
+      processNameCache.set(server.id, names);
+    }
+    const seen = new Map();
+    for (const proc of sample.top_processes) {
+      if (proc.name !== undefined) {
+        seen.set(proc.pid, proc.name);
+      } else if (names.has(proc.pid)) {
+        proc.name = names.get(proc.pid);
+        seen.set(proc.pid, proc.name);
+      } else {
+        result.processNamesRequired = true;
+      }
+    }
+    processNameCache.set(server.id, seen);
+  }
+
+  return result;
+}
+
 exports.ingestFromAgent = async (req, res) => {
   try {
     const server = req.server;
+    const hydration = hydrateSample(server, req.body);
     const {
       // Basic metrics
       cpu_usage,
@@ -92,6 +172,8 @@ exports.ingestFromAgent = async (req, res) => {
       cpu_cores,
       cpu_freq_current,
       cpu_freq_max,
+      cgroups,
+      sockets,
     } = req.body;
 
     const metricsData = {
@@ -125,6 +207,8 @@ exports.ingestFromAgent = async (req, res) => {
       cpu_cores: cpu_cores ? JSON.stringify(cpu_cores) : null,
       cpu_freq_current,
       cpu_freq_max,
+      cgroups: cgroups ? JSON.stringify(cgroups) : null,
+      sockets: sockets ? JSON.stringify(sockets) : null,
     };
 
     await db('server_metrics').insert(metricsData);
@@ -134,14 +218,16 @@ exports.ingestFromAgent = async (req, res) => {
       .where({ id: server.id })
       .update({ status: 'online', last_seen: new Date() });
 
-    // Check alert rules for this server
-    await checkAlertRules(req.app.get('io'), server.id, {
-      cpu_usage,
-      ram_usage_percent,
-      disk_partitions,
-      swap_usage_percent,
-      temperatures,
-    });
+    // Check alert rules for this server (agents evaluating rules themselves push events instead)
+    if (!req.body.edge_alerts) {
+      await checkAlertRules(req.app.get('io'), server.id, {
+        cpu_usage,
+        ram_usage_percent,
+        disk_partitions,
+        swap_usage_percent,
+        temperatures,
+      });
+    }
 
     // Broadcast metrics to subscribed frontend clients in real-time
     const io = req.app.get('io');
@@ -165,13 +251,73 @@ exports.ingestFromAgent = async (req, res) => {
       .where('recorded_at', '<', thirtyDaysAgo)
       .del();
 
-    res.json({ status: 'ok' });
+    res.json({
+      status: 'ok',
+      facts_required: hydration.factsRequired,
+      process_names_required: hydration.processNamesRequired,
+    });
   } catch (err) {
     logger.error('Ingest metrics error:', err);
     res.status(500).json({ error: 'Internal server error' });
   }
 };
 
+/**
+ * Active alert rules that apply to a server (its own, its group's and global rules)
+ */
+function getRulesForServer(server) {
+  return db('alert_rules')
+    .where(function () {
+      this.where('server_id', server.id).orWhere(function () {
+        this.whereNull('server_id').where(function () {
+          this.whereNull('group_id');
+          if (server.group_id) this.orWhere('group_id', server.group_id);
+        });
+      });
+    })
+    .where('is_active', true);
+}
+
+/**
+ * Open an alert for a rule unless one is already active
+ */
+async function raiseAlert(io, serverId, rule, value) {
+  const existingAlert = await db('alerts')
+    .where({ rule_id: rule.id, server_id: serverId, status: 'active' })
+    .first();
+
+  if (existingAlert) return;
+
+  const [alert] = await db('alerts')
+    .insert({
+      rule_id: rule.id,
+      server_id: serverId,
+      metric: rule.metric,
+      value,
+      threshold: rule.threshold,
+      severity: rule.severity,
+      message: `${rule.name}: ${rule.metric} is ${value.toFixed(1)} (threshold: ${rule.threshold})`,
+    })
+    .returning('*');
+
+  // Broadcast alert
+  if (io) {
+    io.emit('server_alert', {
+      server_id: serverId,
+      alert,
+    });
+  }
+
+  // TODO: Send email notification if rule.notify_email
+  // TODO: Send webhook if rule.notify_webhook
+}
+
+function resolveAlerts(serverId, ruleId) {
+  return db('alerts')
+    .where({ rule_id: ruleId, server_id: serverId, status: 'active' })
+    .update({ status: 'resolved', resolved_at: new Date() });
+}
+
 /**
  * Check alert rules against current metrics
  */
@@ -191,41 +337,10 @@ async function checkAlertRules(io, serverId, metrics) {
       const triggered = checkCondition(value, rule.condition, rule.threshold);
 
       if (triggered) {
-        // Check if there's already an active alert for this rule
-        const existingAlert = await db('alerts')
-          .where({ rule_id: rule.id, server_id: serverId, status: 'active' })
-          .first();
-
-        if (!existingAlert) {
-          // Create new alert
-          const [alert] = await db('alerts')
-            .insert({
-              rule_id: rule.id,
-              server_id: serverId,
-              metric: rule.metric,
-              value,
-              threshold: rule.threshold,
-              severity: rule.severity,
-              message: `${rule.name}: ${rule.metric} is ${value.toFixed(1)} (threshold: ${rule.threshold})`,
-            })
-            .returning('*');
-
-          // Broadcast alert
-          if (io) {
-            io.emit('server_alert', {
-              server_id: serverId,
-              alert,
-            });
-          }
-
-          // TODO: Send email notification if rule.notify_email
-          // TODO: Send webhook if rule.notify_webhook
-        }
+        await raiseAlert(io, serverId, rule, value);
       } else {
         // Auto-resolve active alerts for this rule
-        await db('alerts')
-          .where({ rule_id: rule.id, server_id: serverId, status: 'active' })
-          .update({ status: 'resolved', resolved_at: new Date() });
+        await resolveAlerts(serverId, rule.id);
       }
     }
   } catch (err) {
@@ -275,6 +390,40 @@ function checkCondition(value, condition, threshold) {
   }
 }
 
+/**
+ * Alert state changes pushed by agents that evaluate rules locally
+ */
+exports.receiveAlertEvents = async (req, res) => {
+  try {
+    const server = req.server;
+    const { events } = req.body;
+
+    if (!Array.isArray(events)) {
+      return res.status(400).json({ error: 'Events must be an array' });
+    }
+
+    const io = req.app.get('io');
+    const rules = await getRulesForServer(server);
+    const rulesById = new Map(rules.map((rule) => [rule.id, rule]));
+
+    for (const event of events) {
+      const rule = rulesById.get(event.rule_id);
+      if (!rule || typeof event.value !== 'number') continue;
+
+      if (event.status === 'firing') {
+        await raiseAlert(io, server.id, rule, event.value);
+      } else if (event.status === 'resolved') {
+        await resolveAlerts(server.id, rule.id);
+      }
+    }
+
+    res.json({ status: 'ok' });
+  } catch (err) {
+    logger.error('Receive alert events error:', err);
+    res.status(500).json({ error: 'Internal server error' });
+  }
+};
+
 exports.heartbeat = async (req, res) => {
   try {
     const server = req.server;
@@ -284,15 +433,42 @@ exports.heartbeat = async (req, res) => {
       .update({ status: 'online', last_seen: new Date() });
 
     // Check for pending commands
-    const pendingTasks = await db('scheduled_tasks')
-      .where({ server_id: server.id, is_active: true })
-      .whereRaw("next_run <= NOW()")
-      .select('id', 'type', 'script_content', 'cron_expression');
+    const pendingTasks = await getPendingCommands(server.id);
 
-    res.json({
+    // Rule set for edge evaluation on the agent
+    const alertRules = await getRulesForServer(server).select(
+      'id',
+      'name',
+      'metric',
+      'condition',
+      'threshold',
+      'duration_seconds',
+      'hysteresis',
+      'severity'
+    );
+
+    // Rules with an open alert, so the agent can pick up (and later resolve)
+    // alerts raised before it started or before it evaluated rules itself
+    const activeAlertRuleIds = await db('alerts')
+      .where({ server_id: server.id, status: 'active' })
+      .whereIn(
+        'rule_id',
+        alertRules.map((rule) => rule.id)
+      )
+      .distinct()
+      .pluck('rule_id');
+
+    const response = {
       status: 'ok',
       pending_commands: pendingTasks,
-    });
+      alert_rules: alertRules,
+      active_alert_rule_ids: activeAlertRuleIds,
+    };
+    if (config.agent.sampleInterval) {
+      response.sample_interval = config.agent.sampleInterval;
+    }
+
+    res.json(response);
   } catch (err) {
     logger.error('Heartbeat error:', err);
     res.status(500).json({ error: 'Internal server error' });
@@ -36,7 +36,7 @@ exports.list = async (req, res) => {
 exports.syncFromAgent = async (req, res) => {
   try {
     const server = req.server;
-    const { packages } = req.body;
+    const { packages, prestage } = req.body;
 
     if (!Array.isArray(packages)) {
       return res.status(400).json({ error: 'Packages must be an array' });
@@ -53,6 +53,7 @@ exports.syncFromAgent = async (req, res) => {
           version: pkg.version,
           description: pkg.description || null,
           available_update: pkg.available_update || null,
+          prestaged: !!pkg.prestaged,
           last_checked: new Date(),
         }));
 
@@ -61,6 +62,10 @@ exports.syncFromAgent = async (req, res) => {
           await trx('server_packages').insert(records.slice(i, i + 500));
         }
       }
+
+      await trx('servers')
+        .where({ id: server.id })
+        .update({ package_prestage: prestage ? JSON.stringify(prestage) : null });
     });
 
     res.json({ status: 'ok', synced: packages.length });
@@ -40,7 +40,15 @@ exports.get = async (req, res) => {
 
 exports.create = async (req, res) => {
   try {
-    const { name, description, type, cron_expression, script_content, is_active } = req.body;
+    const {
+      name,
+      description,
+      type,
+      cron_expression,
+      script_content,
+      is_active,
+      resource_profile,
+    } = req.body;
 
     const [task] = await db('scheduled_tasks')
       .insert({
@@ -51,6 +59,7 @@ exports.create = async (req, res) => {
         cron_expression,
         script_content: type === 'script' ? script_content : null,
         is_active: is_active !== false,
+        resource_profile: resource_profile || null,
         created_by: req.user.id,
       })
       .returning('*');
@@ -72,7 +81,15 @@ exports.create = async (req, res) => {
 
 exports.update = async (req, res) => {
   try {
-    const { name, description, type, cron_expression, script_content, is_active } = req.body;
+    const {
+      name,
+      description,
+      type,
+      cron_expression,
+      script_content,
+      is_active,
+      resource_profile,
+    } = req.body;
 
     const updates = {};
     if (name !== undefined) updates.name = name;
@@ -81,6 +98,7 @@ exports.update = async (req, res) => {
     if (cron_expression !== undefined) updates.cron_expression = cron_expression;
     if (script_content !== undefined) updates.script_content = script_content;
     if (is_active !== undefined) updates.is_active = is_active;
+    if (resource_profile !== undefined) updates.resource_profile = resource_profile || null;
 
     const [task] = await db('scheduled_tasks')
       .where({ id: req.params.taskId, server_id: req.params.serverId })
@@ -117,7 +135,9 @@ exports.remove = async (req, res) => {
 
 exports.reportTaskResult = async (req, res) => {
   try {
-    const { task_id, status, output } = req.body;
+    const { task_id, status, resource_usage } = req.body;
+    // Update results come back as log_output
+    const output = req.body.output ?? req.body.log_output;
     const server = req.server;
 
     await db('task_logs').insert({
@@ -125,6 +145,7 @@ exports.reportTaskResult = async (req, res) => {
       server_id: server.id,
       status,
       output,
+      resource_usage: resource_usage ? JSON.stringify(resource_usage) : null,
       started_at: new Date(),
       completed_at: ['completed', 'failed'].includes(status) ? new Date() : null,
     });
@@ -0,0 +1,35 @@
+const express = require('express');
+const logger = require('../services/logger');
+
+// Optional: agents configured with "serializer": "msgpack" need @msgpack/msgpack installed
+let msgpack = null;
+try {
+  msgpack = require('@msgpack/msgpack');
+} catch (e) {
+  msgpack = null;
+}
+
+const rawMsgpack = express.raw({ type: 'application/msgpack', limit: '10mb' });
+
+const decodeMsgpack = (req, res, next) => {
+  if (!req.is('application/msgpack')) {
+    return next();
+  }
+
+  if (!msgpack) {
+    return res.status(415).json({ error: 'msgpack payloads are not supported by this server' });
+  }
+
+  rawMsgpack(req, res, (err) => {
+    if (err) return next(err);
+    try {
+      req.body = msgpack.decode(req.body);
+      next();
+    } catch (decodeErr) {
+      logger.warn('Invalid msgpack payload:', decodeErr.message);
+      res.status(400).json({ error: 'Invalid msgpack payload' });
+    }
+  });
+};
+
+module.exports = { decodeMsgpack };
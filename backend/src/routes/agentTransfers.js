@@ -0,0 +1,58 @@
+const express = require('express');
+const fs = require('fs');
+const path = require('path');
+const multer = require('multer');
+const { v4: uuidv4 } = require('uuid');
+const router = express.Router();
+const agentTransferController = require('../controllers/agentTransferController');
+const { authenticate, authorizeServerAccess } = require('../middleware/auth');
+const { authenticateAgent } = require('../middleware/agentAuth');
+
+const storage = multer.diskStorage({
+  destination: (req, file, cb) => {
+    const dir = path.join(agentTransferController.TRANSFER_DIR, req.params.serverId);
+    fs.mkdirSync(dir, { recursive: true });
+    cb(null, dir);
+  },
+  filename: (req, file, cb) => cb(null, uuidv4()),
+});
+
+const upload = multer({
+  storage,
+  limits: { fileSize: 10 * 1024 * 1024 * 1024 }, // 10GB
+});
+
+const rawChunk = express.raw({
+  type: 'application/octet-stream',
+  limit: agentTransferController.MAX_CHUNK_SIZE,
+});
+
+// User routes
+router.post(
+  '/servers/:serverId/transfers',
+  authenticate,
+  authorizeServerAccess,
+  upload.single('file'),
+  agentTransferController.stage
+);
+
+router.post(
+  '/servers/:serverId/transfers/upload-requests',
+  authenticate,
+  authorizeServerAccess,
+  agentTransferController.requestUpload
+);
+
+router.get(
+  '/servers/:serverId/transfers/:transferId',
+  authenticate,
+  authorizeServerAccess,
+  agentTransferController.download
+);
+
+// Agent routes
+router.get('/agent/files/status', authenticateAgent, agentTransferController.getStatus);
+router.get('/agent/files/chunk', authenticateAgent, agentTransferController.sendChunk);
+router.post('/agent/files/chunk', authenticateAgent, rawChunk, agentTransferController.receiveChunk);
+
+module.exports = router;
@@ -21,22 +21,23 @@ const upload = multer({
   limits: { fileSize: 50 * 1024 * 1024 }, // 50MB
 });
 
-router.use(authenticate);
-
 router.get(
   '/servers/:serverId/documents',
+  authenticate,
   authorizeServerAccess,
   documentController.list
 );
 
 router.get(
   '/servers/:serverId/documents/:docId',
+  authenticate,
   authorizeServerAccess,
   documentController.get
 );
 
 router.post(
   '/servers/:serverId/documents',
+  authenticate,
   authorize('admin', 'user'),
   authorizeServerAccess,
   [body('title').notEmpty().withMessage('Title is required')],
@@ -46,6 +47,7 @@ router.post(
 
 router.put(
   '/servers/:serverId/documents/:docId',
+  authenticate,
   authorize('admin', 'user'),
   authorizeServerAccess,
   documentController.update
@@ -53,6 +55,7 @@ router.put(
 
 router.delete(
   '/servers/:serverId/documents/:docId',
+  authenticate,
   authorize('admin'),
   authorizeServerAccess,
   documentController.remove
@@ -60,6 +63,7 @@ router.delete(
 
 router.post(
   '/servers/:serverId/documents/:docId/attachments',
+  authenticate,
   authorize('admin', 'user'),
   authorizeServerAccess,
   upload.single('file'),
@@ -68,6 +72,7 @@ router.post(
 
 router.get(
   '/documents/attachments/:attachmentId/download',
+  authenticate,
   documentController.downloadAttachment
 );
 
@@ -38,6 +38,22 @@ router.post(
   logController.requestLogContent
 );
 
+// Queue a streaming search on the agent (specific path - must be before /logs)
+router.post(
+  '/servers/:serverId/logs/search',
+  authenticate,
+  authorizeServerAccess,
+  logController.requestLogSearch
+);
+
+// Queue an incremental journald read on the agent (specific path - must be before /logs)
+router.post(
+  '/servers/:serverId/logs/journal',
+  authenticate,
+  authorizeServerAccess,
+  logController.requestJournalRead
+);
+
 // Remove a log path (has :logId param)
 router.delete(
   '/servers/:serverId/logs/:logId',
@@ -64,5 +80,6 @@ router.post(
 
 // Agent routes (legacy)
 router.post('/agent/logs/content', authenticateAgent, logController.receiveLogContent);
+router.post('/agent/logs/search-results', authenticateAgent, logController.receiveLogSearchResults);
 
 module.exports = router;
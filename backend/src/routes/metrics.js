@@ -22,5 +22,7 @@ router.get(
 // Agent routes
 router.post('/agent/metrics', authenticateAgent, metricsController.ingestFromAgent);
 router.post('/agent/heartbeat', authenticateAgent, metricsController.heartbeat);
+router.post('/agent/facts', authenticateAgent, metricsController.receiveHostFacts);
+router.post('/agent/alerts/events', authenticateAgent, metricsController.receiveAlertEvents);
 
 module.exports = router;
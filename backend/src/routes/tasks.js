@@ -6,6 +6,12 @@ const { authenticate, authorize, authorizeServerAccess } = require('../middlewar
 const { authenticateAgent } = require('../middleware/agentAuth');
 const { validate } = require('../middleware/validator');
 
+// Profile names are defined in the agent config (resource_profiles)
+const resourceProfileRule = body('resource_profile')
+  .optional({ nullable: true })
+  .matches(/^[\w-]{0,50}$/)
+  .withMessage('Invalid resource profile name');
+
 // User routes
 router.get(
   '/servers/:serverId/tasks',
@@ -30,6 +36,7 @@ router.post(
     body('name').notEmpty().withMessage('Task name is required'),
     body('type').isIn(['update', 'reboot', 'script']).withMessage('Invalid task type'),
     body('cron_expression').notEmpty().withMessage('Cron expression is required'),
+    resourceProfileRule,
   ],
   validate,
   taskController.create
@@ -40,6 +47,8 @@ router.put(
   authenticate,
   authorize('admin', 'user'),
   authorizeServerAccess,
+  [resourceProfileRule],
+  validate,
   taskController.update
 );
 
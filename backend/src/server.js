@@ -11,6 +11,7 @@ const path = require('path');
 const config = require('./config/app');
 const logger = require('./services/logger');
 const setupSocket = require('./websocket/socketHandler');
+const { decodeMsgpack } = require('./middleware/msgpack');
 
 // Routes
 const authRoutes = require('./routes/auth');
@@ -30,6 +31,7 @@ const fileManagerRoutes = require('./routes/fileManager');
 const firewallRoutes = require('./routes/firewall');
 const sshIdentityRoutes = require('./routes/sshIdentities');
 const agentInstallRoutes = require('./routes/agentInstall');
+const agentTransferRoutes = require('./routes/agentTransfers');
 
 const app = express();
 const server = http.createServer(app);
@@ -55,6 +57,7 @@ app.use(helmet({ contentSecurityPolicy: false }));
 app.use(compression());
 app.use(cors({ origin: config.frontendUrl, credentials: true }));
 app.use(express.json({ limit: '10mb' }));
+app.use('/api/agent', decodeMsgpack);
 app.use(express.urlencoded({ extended: true }));
 app.use(morgan('combined', { stream: { write: (msg) => logger.info(msg.trim()) } }));
 
@@ -63,6 +66,9 @@ const apiLimiter = rateLimit({
   windowMs: 15 * 60 * 1000,
   max: 1000,
   message: { error: 'Too many requests, please try again later' },
+  // Agents authenticate by API key and pace themselves (backoff, Retry-After);
+  // metrics, heartbeats and file transfer chunks would exhaust a per-IP budget
+  skip: (req) => req.path.startsWith('/agent/'),
 });
 
 const loginLimiter = rateLimit({
@@ -84,6 +90,7 @@ app.use('/api/groups', groupRoutes);
 app.use('/api', metricsRoutes);
 app.use('/api', packageRoutes);
 app.use('/api', taskRoutes);
+app.use('/api', agentTransferRoutes);
 app.use('/api', documentRoutes);
 app.use('/api/users', userRoutes);
 app.use('/api', logRoutes);
@@ -224,6 +231,16 @@ setInterval(async () => {
   }
 }, 300000); // Run every 5 minutes
 
+// Transfer cleanup - remove staged and finished agent file transfers past retention
+const agentTransferController = require('./controllers/agentTransferController');
+setInterval(async () => {
+  try {
+    await agentTransferController.cleanup();
+  } catch (err) {
+    logger.error('Transfer cleanup error:', err);
+  }
+}, 3600000); // Run every hour
+
 // Start backup scheduler
 const backupScheduler = require('./services/backupScheduler');
 backupScheduler.start(io);
@@ -0,0 +1,53 @@
+const db = require('../config/database');
+const { ONE_SHOT_TASK_TYPES } = require('../config/taskTypes');
+
+// Columns sent to the agent with each pending command
+const COMMAND_COLUMNS = [
+  'id',
+  'type',
+  'script_content',
+  'cron_expression',
+  'params',
+  'resource_profile',
+];
+
+const queueAgentCommand = async ({ serverId, type, name, params, userId }) => {
+  const [task] = await db('scheduled_tasks')
+    .insert({
+      server_id: serverId,
+      name,
+      type,
+      cron_expression: '@once',
+      params: JSON.stringify(params || {}),
+      is_active: true,
+      next_run: new Date(),
+      created_by: userId,
+    })
+    .returning('*');
+  return task;
+};
+
+const getPendingCommands = async (serverId) => {
+  const scheduled = await db('scheduled_tasks')
+    .where({ server_id: serverId, is_active: true })
+    .whereNotIn('type', ONE_SHOT_TASK_TYPES)
+    .whereRaw('next_run <= NOW()')
+    .select(COMMAND_COLUMNS);
+
+  // Claim one-shot commands in the same statement that deactivates them,
+  // so overlapping heartbeats cannot hand the same command out twice
+  const oneShot = await db('scheduled_tasks')
+    .where({ server_id: serverId, is_active: true })
+    .whereIn('type', ONE_SHOT_TASK_TYPES)
+    .whereRaw('next_run <= NOW()')
+    .update({ is_active: false, last_run: new Date() })
+    .returning(COMMAND_COLUMNS);
+
+  return [...scheduled, ...oneShot];
+};
+
+module.exports = {
+  ONE_SHOT_TASK_TYPES,
+  queueAgentCommand,
+  getPendingCommands,
+};